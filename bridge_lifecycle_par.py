@@ -12,18 +12,15 @@ import numpy as np
 import scipy.stats as stats
 import pyNBI.bridge as pybridge
 import pyNBI.traffic as pytraffic
+from pyNBI.lifecycle import LifecycleEngine
 
 import pyDUE.generate_graph as g
+import pyDUE.ue_solver as ue
 from cvxopt import matrix, mul
 
-from multiprocessing import Pool, Manager
-import itertools
-
 import time
 import datetime
 
-# global variables for parallel computing... stupid multiprocessing in Python
-
 # open databases
 conn_gis = psycopg2.connect("dbname='gisdatabase' user='amadeus' host='localhost' password=''")
 cur_gis = conn_gis.cursor()
@@ -45,41 +42,26 @@ graph = g.test_LA(parameters=theta,delaytype=delaytype)
 
 # capacity drop
 cap_drop_array = np.ones(np.asarray(bridge_db, dtype=object).shape[0])*0.1
-# get current cs distribution
-cs_dist = pytraffic.condition_distribution(t, bridge_db, pmatrix)
 # time of interest
 time_array = np.arange(0, 110, 10)
 # number of smps
 nsmp = int(1e4)
-# create bookkeeping dict
-bookkeeping = {}
-manager = Manager()
-bookkeeping = manager.dict(bookkeeping)
-
-def loop_over_time(t):
-    t, smp = pytraffic.delay_history(nsmp, graph, t, bridge_db, cs_dist, cap_drop_array, theta, delaytype, bookkeeping)
-    return t, smp
 
 def main():
     start_delta_time = time.time()
-    print 'CALC: Parallel version'
-    try:
-        pool = Pool(processes = 1)
-        res = pool.map_async(loop_over_time, time_array).get(0xFFFF)
-        pool.close()
-        pool.join()
-    except KeyboardInterrupt:
-        print "Caught KeyboardInterrupt, terminating workers"
-        pool.terminate()
-        pool.join()
+    print 'CALC: Lifecycle engine'
+    # all years in one pass, sharing the UE results of failure profiles
+    x0 = ue.solver_fw(graph)
+    engine = LifecycleEngine(graph, bridge_db, pmatrix, cap_drop_array, theta, delaytype, x0=x0)
+    total_delay_history, total_distance_history = engine.run(nsmp, time_array)
     delta_time = time.time() - start_delta_time
     print 'DONE',str(datetime.timedelta(seconds=delta_time))
-    return res
+    print 'UE cache:', engine.bookkeeping.stats()
+    return time_array, total_delay_history
 
 if __name__ == '__main__':
-    res = main()
-    time_array = np.asarray(res, dtype=object)[:,0].astype('int')
-    total_delay_history = np.vstack(np.asarray(res, dtype=object)[:,1]).T/3600.
+    time_array, total_delay_history = main()
+    total_delay_history = total_delay_history/3600.
     import matplotlib.pyplot as plt
     plt.ion()
     plt.rc('font', family='serif', size=12)
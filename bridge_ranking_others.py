@@ -11,6 +11,7 @@ import sys
 import numpy as np
 from scipy import stats
 from pyNBI.traffic import cs2reliable
+from pyNBI.risk import detour_cost
 
 import time
 import datetime
@@ -84,26 +85,7 @@ def onebridge_directcost(indx, bridge_db, t):
 
 def onebridge_indirectcost(indx, bridge_db, t, adt):
     """compute social cost according to Saydam and Frangopol (2011)"""
-    TRUCK2TRAFFIC = 0.12    # Average Daily Truck Traffic (ADTT) to Average Daily Traffic (ADT)
-    TRUCK_COMP = 26.97    # average compensation for truck drivers, USD/h
-    CAR_OCCUPY = 1.5        # average vehicle occupancies for cars
-    TRUCK_OCCUPY = 1.05     # average vehicle occupancies for trucks
-    CAR_WAGE = 22.82        # average wage of car drivers, USD/h
-    DISCOUNT_RATE = 0.00    # discount rate
-    CAR_RUN_COST = 0.08     # running cost for cars, USD/km
-    TRUCK_RUN_COST = 0.375  # running cost for trucks, USD/km
-    CARGO_VALUE = 4.        # time value of a cargo
-
-    name, lat, long, length, width, deck_cs0, super_cs0, sub_cs0, detour, onlink = bridge_db[indx]
-    freespeed = 30.         # m/s
-
-    price_time = (detour*1e3/freespeed/3600.*(1.-TRUCK2TRAFFIC)*CAR_OCCUPY*CAR_WAGE +
-        detour*1e3/freespeed/3600.*TRUCK2TRAFFIC*(TRUCK_COMP*TRUCK_OCCUPY+CARGO_VALUE))*(1+DISCOUNT_RATE)**t
-    price_run = (detour*(1.-TRUCK2TRAFFIC)*CAR_RUN_COST +
-            detour*TRUCK2TRAFFIC*TRUCK_RUN_COST)*(1+DISCOUNT_RATE)**t
-    total_cost = adt*(price_time+price_run)
-
-    return total_cost
+    return detour_cost(bridge_db[indx:indx+1], t, adt)[0]
 
 
 
@@ -11,17 +11,15 @@ import sys
 import numpy as np
 import pyNBI.traffic as pytraffic
 from pyNBI.risk import social_cost
+from pyNBI.ranking import RiskEngine
+from pyNBI.store import RunStore
 
-from multiprocessing import Pool, Manager, freeze_support, Queue, Process
-import Queue as queue
-import itertools
+from multiprocessing import freeze_support
 
 import time
 import datetime
 import shelve
 
-# global variables for parallel computing... stupid multiprocessing in Python
-
 # to restore workspace import global variables
 filename = os.path.join(os.path.abspath('./'), 'Data', 'Python', 'metadata.out')
 my_shelf = shelve.open(filename, 'r')
@@ -36,66 +34,68 @@ cs_dist = pytraffic.condition_distribution(t, bridge_db, pmatrix)
 cost0 = social_cost(delay0, distance0, t)
 # number of smps
 nsmp = int(10000)
-
-#def loop_over_bridges(bridge_indx, bookkeeping):
-def loop_over_bridges(bridge_indx):
-    indx, smp = pytraffic.delay_samples(nsmp, graph0, cost0, all_capacity, t, bridge_indx,
-            bridge_db, cs_dist, cap_drop_array, theta, delaytype,
-            correlation=norm_cov, nataf=nataf, corrcoef=0., x0=res0[0], bookkeeping={})
-
-    return indx, smp
-
-def tmpfunc(bridge_indx,q):
-    indx,smp =  loop_over_bridges(bridge_indx)
-    q.put((indx,smp))
+# number of smps per work unit
+block_size = 100
+# seed of the work units
+seed = None
+# adaptive ranking: rounds of block_size samples per bridge until its rank is
+# settled (at most nsmp samples per bridge) instead of nsmp samples for all
+adaptive = False
+# screening: number of bridges kept for MC, by their first-order risks
+# (pytraffic.screening_risks) from the UE of the undamaged network (all if None)
+nscreen = None
+# samples of each block are appended to a new run store of each run
+# (data.samples in the result folder) as they are done (not with adaptive
+# ranking); to resume an interrupted run, set resume_store to its run store
+resume_store = None
 
 if __name__ == '__main__':
     freeze_support()
     nprocess = 17
-    #manager = Manager()
-    #bookkeeping = manager.dict(bookkeeping)
+
+    # result folder of the run (that of the resumed run if any)
+    if resume_store is None:
+        dir_name = os.path.join(os.path.abspath('./'), 'figures',
+            'ranking_LA '+str(datetime.datetime.now()).replace(':', '-'))
+        run_store = os.path.join(dir_name, 'data.samples')
+    else:
+        dir_name, run_store = os.path.dirname(resume_store), resume_store
 
     start_delta_time = time.time()
     print 'CALC: Parallel version'
+    # network state is shared with the workers once, samples are run in blocks
+    engine = RiskEngine(graph0, cost0, all_capacity, t, bridge_db, cs_dist, cap_drop_array,
+            theta, delaytype, correlation=norm_cov, nataf=nataf, corrcoef=0., x0=res0[0])
+    bridge_indx = np.arange(bridge_db.shape[0])
+    if nscreen is not None:
+        screening_risk = pytraffic.screening_risks(graph0, all_capacity, t, bridge_db, cs_dist, cap_drop_array,
+                theta, res0[0])
+        bridge_indx = np.sort(np.argsort(-screening_risk)[:nscreen])
+        print 'SCREENING: {} of {} bridges kept'.format(bridge_indx.size, bridge_db.shape[0])
     try:
-        pool = Pool(processes = nprocess)
-        res = pool.map_async(loop_over_bridges, np.arange(bridge_db.shape[0])).get(0xFFFFFFFF)
-        #res = pool.map_async(loop_over_bridges, np.arange(10)).get(0xFFFFFFFF)
-        #res = pool.map_async(loop_over_bridges, np.zeros(nprocess, dtype=int)).get(0xFFFFFFFF)
-        #results = [pool.apply_async(loop_over_bridges, (b,)) for b in np.arange(30)]
-
-        #res = [r.get() for r in results]
-        #res = map(loop_over_bridges, np.arange(1))
-        #res = pool.map_async(loop_over_bridges,
-                #itertools.izip(itertools.repeat(nsmp), itertools.repeat(graph0), itertools.repeat(cost0),
-                    #itertools.repeat(all_capacity), np.arange(bridge_db.shape[0]), itertools.repeat(bridge_db),
-                    #itertools.repeat(cs_dist), itertools.repeat(cap_drop_array), itertools.repeat(theta),
-                    #itertools.repeat(delaytype), itertools.repeat(correlation), itertools.repeat(nataf),
-                    #itertools.repeat(bookkeeping))).get(0xFFFF)
-        #res = pool.map_async(tmpfunc,itertools.izip(np.arange(bridge_db.shape[0]), itertools.repeat(bookkeeping))).get(0xFFFF)
-        pool.close()
-        pool.join()
-
-        #q = Queue()
-        #for bridge_indx in np.zeros(10, dtype=int):
-            #p = Process(target=tmpfunc, args=(bridge_indx,q))
-            #p.start()
-        #for bridge_indx in np.zeros(10, dtype=int):
-            #p.join()
-        #res = []
-        #while True:
-            #try:
-                #res.append(q.get(timeout=10))
-            #except queue.Empty:
-                #break
-
+        if adaptive:
+            # bridge_risk_data: list of the risk samples of each bridge (as many as needed to settle it)
+            order, risk_mean, risk_var, bridge_nsmp, settled, bridge_risk_data = engine.rank(bridge_indx,
+                    round_size=block_size, max_nsmp=nsmp, nprocess=nprocess, seed=seed, verbose=True, full=True)
+        else:
+            store = RunStore(run_store, resume=resume_store is not None)
+            bridge_risk_data = engine.run(bridge_indx, nsmp, block_size=block_size, nprocess=nprocess, seed=seed,
+                    store=store)
+            store.close()
+            risk_mean = np.mean(bridge_risk_data, axis=0)
+            order = list(bridge_indx[np.argsort(-risk_mean, kind='mergesort')])
     except KeyboardInterrupt:
         print "Caught KeyboardInterrupt, terminating workers"
-        pool.terminate()
-        pool.join()
+        if not adaptive:
+            print 'Completed blocks are kept in {}, set resume_store to resume'.format(run_store)
         sys.exit(1)
     delta_time = time.time() - start_delta_time
     print 'DONE',str(datetime.timedelta(seconds=delta_time))
+    if engine.cache is not None:
+        print 'UE cache: {hits} hits, {misses} misses, {size} profiles'.format(**engine.cache.stats())
+    # the engine (shared memory of the pool) and the run store are not shelved
+    del engine
+    if not adaptive: del store
 
     #start_delta_time = time.time()
     #print 'CALC: Series version'
@@ -103,8 +103,6 @@ if __name__ == '__main__':
     #delta_time = time.time() - start_delta_time
     #print 'DONE',str(datetime.timedelta(seconds=delta_time))
 
-    bridge_indx = np.asarray(res, dtype=object)[:,0].astype('int')
-    bridge_risk_data = np.vstack(np.asarray(res, dtype=object)[:,1]).T
 
     ## postprocessing
     #import matplotlib.pyplot as plt
@@ -126,8 +124,6 @@ if __name__ == '__main__':
 
     # save data
     import shelve
-    dir_name = os.path.join(os.path.abspath('./'), 'figures',
-        'ranking_LA '+str(datetime.datetime.now()).replace(':', '-'))
     if not os.path.exists(dir_name):
         os.makedirs(dir_name)
     #plt.savefig(os.path.join(dir_name,'bridge_ranking_LA.eps'))
@@ -58,7 +58,7 @@ def main():
         for nsmp in nsmp_array:
             for i in xrange(nsmp):
                 #update_func(graph, capacity, initial=True)
-                graph = copy.deepcopy(graph0)
+                graph = graph0.overlay()
                 bridge_pfs = update_func(graph, capacity, bridge_indx=bridge_indx)
                 res = solver_fw(graph, full=True)
                 total_delay.append(res[1][0,0])
@@ -7,6 +7,8 @@ Created on Apr 18, 2014
 from cvxopt import matrix
 import numpy as np
 import logging
+import copy
+from collections import MutableMapping
 
 class Graph:
     """Class Graph containing nodes, links, ODs, paths for traffic assignment"""
@@ -300,6 +302,98 @@ class Graph:
                 intlk_ids.append(id)
         return intlk_ids
 
+
+    def overlay(self):
+        """Create a GraphOverlay (scenario) of the graph"""
+        return GraphOverlay(self)
+
+
+class LinkOverlay(MutableMapping):
+    """Links of a GraphOverlay: the links of a base dict, with the links set
+    in the overlay (e.g. by modify_link) shadowing the base links"""
+    def __init__(self, base):
+        self.base = base
+        self.modified = {}
+
+    def __getitem__(self, key):
+        if key in self.modified: return self.modified[key]
+        return self.base[key]
+
+    def __setitem__(self, key, link):
+        if key not in self.base: logging.error('link {} is not in the base graph'.format(key)); return
+        self.modified[key] = link
+
+    def __delitem__(self, key):
+        self.modified.pop(key, None)
+
+    def __contains__(self, key):
+        return key in self.base
+
+    def __iter__(self):
+        return iter(self.base)
+
+    def __len__(self):
+        return len(self.base)
+
+
+class GraphOverlay(Graph):
+    """Scenario of a base Graph with copy-on-write links
+
+    Nodes, ODs, paths and indexations are shared with the base graph, and only
+    the links modified in the scenario (by modify_link, modify_links_from_lists
+    or update_linkflows_linkdelays) are stored in the overlay, so that creating
+    a scenario does not copy the network (unlike copy.deepcopy). The base graph
+    must not be modified while its overlays are in use. Other attributes (e.g.
+    the cached shortest-path engine) are read from the base graph.
+    """
+    def __init__(self, base):
+        self.base = base
+        self.description = base.description
+        self.nodes, self.ODs, self.paths = base.nodes, base.ODs, base.paths
+        self.numnodes, self.numlinks = base.numnodes, base.numlinks
+        self.numODs, self.numpaths = base.numODs, base.numpaths
+        self.nodes_position = base.nodes_position
+        self.indlinks, self.indods, self.indpaths = base.indlinks, base.indods, base.indpaths
+        self.links = LinkOverlay(base.links)
+
+    def __getattr__(self, name):
+        # only called for attributes missing in the overlay
+        if name.startswith('__') or 'base' not in self.__dict__: raise AttributeError(name)
+        return getattr(self.base, name)
+
+    def add_node(self, position=None):
+        logging.error('nodes cannot be added to a GraphOverlay')
+
+    def add_link(self, *args, **kwargs):
+        logging.error('links cannot be added to a GraphOverlay')
+
+    def add_od(self, *args, **kwargs):
+        logging.error('ODs cannot be added to a GraphOverlay')
+
+    def add_path(self, *args, **kwargs):
+        logging.error('paths cannot be added to a GraphOverlay')
+
+    def modified_links(self):
+        """Keys of the links modified in the scenario"""
+        return self.links.modified.keys()
+
+    def reset(self):
+        """Drop all modifications, so that the overlay can be reused for a new scenario"""
+        self.links.modified.clear()
+
+    def update_linkflows_linkdelays(self, linkflows):
+        """Update link flows and link delays in the overlay (links of the base
+        graph are copied before being updated)"""
+        modified = self.links.modified
+        for id,link in self.links.base.iteritems():
+            if id not in modified: modified[id] = copy.copy(link)
+        Graph.update_linkflows_linkdelays(self, linkflows)
+
+    def update_pathdelays(self):
+        """Paths are shared with the base graph and are not updated"""
+        if self.numpaths > 0: logging.error('path delays are not updated in a GraphOverlay')
+
+
 class Link:
     """A link in the graph"""
     def __init__(self, startnode, endnode, route, flow=0.0, delay=0.0, ffdelay=0.0, delayfunc=None,
@@ -0,0 +1,139 @@
+import numpy as np
+
+# links of a bush carrying less than FLOW_TOL times the largest link flow of
+# its initial tree are unused (round-off left by flow shifts)
+FLOW_TOL = 1e-12
+
+
+class BushTopology:
+    """Incoming links of each node of a ShortestPathEngine (links sorted by end
+    node), shared by the bushes of all origins"""
+    def __init__(self, engine):
+        n = engine.numnodes
+        self.linkstart = engine.linkstart
+        self.linkend = engine.pairkey[engine.link2pair] % n
+        self.inlinks = np.argsort(self.linkend, kind='mergesort')
+        self.inptr = np.searchsorted(self.linkend[self.inlinks], np.arange(n+1))
+
+
+class OriginBush:
+    """Acyclic bush of one origin for algorithm B according to Dial (2006)
+
+    The bush is a boolean mask over links (indexed by graph.indlinks) with the
+    link flows of the origin; its nodes are kept in a topological order (the
+    order of the longest path costs from the origin, with positive link costs).
+
+    Parameters
+    ----------
+    topology: BushTopology
+    origin: 0-based origin node
+    dist, inlink: shortest-path tree of the origin (rows of shortest_path_trees)
+    flow: link flows of the origin loaded on the tree
+    """
+    def __init__(self, topology, origin, dist, inlink, flow):
+        self.topology = topology
+        self.origin = origin
+        self.links = np.zeros(topology.linkstart.size, dtype=bool)
+        self.links[inlink[inlink >= 0]] = True
+        reachable = np.flatnonzero(np.isfinite(dist))
+        self.order = reachable[np.argsort(dist[reachable], kind='mergesort')]
+        self.flow = np.asarray(flow, dtype=float)
+        self.floweps = FLOW_TOL*np.max(self.flow) if self.flow.size else 0.
+
+    def labels(self, linkcosts):
+        """Path cost labels of the nodes of the bush in topological order
+
+        Return value
+        ------------
+        L, Lpred: cost of and last link on the shortest path in the bush
+        U, Upred: cost of and last link on the longest path of used links
+            (the shortest path if no link into the node is used)
+        Uall: cost of the longest path in the bush
+        """
+        t = self.topology
+        n = t.inptr.size-1
+        L, U, Uall = np.inf*np.ones(n), -np.inf*np.ones(n), -np.inf*np.ones(n)
+        Lpred, Upred = -np.ones(n, dtype=int), -np.ones(n, dtype=int)
+        L[self.origin], U[self.origin], Uall[self.origin] = 0., 0., 0.
+        for j in self.order[1:]:
+            links = t.inlinks[t.inptr[j]:t.inptr[j+1]]
+            links = links[self.links[links]]
+            if links.size == 0: continue
+            cost = L[t.linkstart[links]] + linkcosts[links]
+            k = np.argmin(cost)
+            L[j], Lpred[j] = cost[k], links[k]
+            Uall[j] = np.max(Uall[t.linkstart[links]] + linkcosts[links])
+            used = links[self.flow[links] > self.floweps]
+            if used.size == 0:
+                U[j], Upred[j] = L[j], Lpred[j]
+                continue
+            cost = U[t.linkstart[used]] + linkcosts[used]
+            k = np.argmax(cost)
+            U[j], Upred[j] = cost[k], used[k]
+        return L, Lpred, U, Upred, Uall
+
+    def update(self, linkflows, linkcosts):
+        """Drop unused links (but the shortest-path tree of the bush) and add
+        the links that shorten the longest paths of the bush; the round-off
+        flow of the dropped links is removed from the bush and from linkflows"""
+        t = self.topology
+        L, Lpred, U, Upred, Uall = self.labels(linkcosts)
+        links = self.flow > self.floweps
+        links[Lpred[Lpred >= 0]] = True
+        self.clear(linkflows, np.flatnonzero(self.links & ~links))
+        self.links &= links
+        Uall = self.labels(linkcosts)[4]
+        ustart, uend = Uall[t.linkstart], Uall[t.linkend]
+        valid = np.isfinite(ustart) & np.isfinite(uend)
+        shortcut = np.zeros(self.links.size, dtype=bool)
+        shortcut[valid] = ustart[valid] + linkcosts[valid] < uend[valid]
+        self.links |= shortcut
+        # links of the bush go from lower to higher longest path costs
+        self.order = self.order[np.argsort(Uall[self.order], kind='mergesort')]
+
+    def clear(self, linkflows, links):
+        """Set the flows of links of the bush to exactly 0, linkflows of all
+        origins being updated consistently"""
+        linkflows[links] = np.maximum(linkflows[links]-self.flow[links], 0.)
+        self.flow[links] = 0.
+
+    def equilibrate(self, kernel, linkflows, linkcosts, ddelay):
+        """Shift flow from the longest to the shortest path segment to each
+        node of the bush (from the last node in topological order) with a
+        Newton step; linkflows, linkcosts and ddelay (derivatives of link
+        costs) of all origins are updated in place"""
+        t = self.topology
+        L, Lpred, U, Upred, Uall = self.labels(linkcosts)
+        for j in self.order[:0:-1]:
+            if U[j] <= L[j]: continue
+            # nodes of the shortest path to j
+            onmin, v = {j: 0}, j
+            while Lpred[v] >= 0:
+                v = t.linkstart[Lpred[v]]
+                onmin[v] = len(onmin)
+            # longest path back to the first node on the shortest path
+            maxseg, v = [], j
+            while True:
+                maxseg.append(Upred[v])
+                v = t.linkstart[Upred[v]]
+                if v in onmin: break
+            minseg, w = [], j
+            for k in xrange(onmin[v]):
+                minseg.append(Lpred[w])
+                w = t.linkstart[Lpred[w]]
+            maxseg, minseg = np.array(maxseg), np.array(minseg)
+            dcost = np.sum(linkcosts[maxseg]) - np.sum(linkcosts[minseg])
+            if dcost <= 0.: continue
+            fmin = np.min(self.flow[maxseg])
+            delta = min(fmin, dcost/(np.sum(ddelay[maxseg])+np.sum(ddelay[minseg])))
+            if delta <= 0.: continue
+            # the bottleneck links of the longest segment are emptied exactly
+            bottleneck = maxseg[self.flow[maxseg] - delta <= self.floweps]
+            self.flow[maxseg] -= delta
+            self.flow[minseg] += delta
+            linkflows[maxseg] -= delta
+            linkflows[minseg] += delta
+            self.clear(linkflows, bottleneck)
+            seg = np.append(maxseg, minseg)
+            linkcosts[seg] = kernel.compute_delay(linkflows, seg)
+            ddelay[seg] = kernel.compute_ddelay(linkflows, seg)
@@ -0,0 +1,119 @@
+import numpy as np
+from cvxopt import matrix
+import logging
+import Graph as g
+
+# arrays of a CompactGraph and their types (links in graph.indlinks order,
+# ODs in graph.indods order, nodes indexed by id-1)
+FIELDS = [('nodes_position', np.float64), ('start', np.int32), ('end', np.int32), ('route', np.int32),
+        ('ffdelay', np.float64), ('slope', np.float64), ('coef', np.float64), ('capacity', np.float64),
+        ('length', np.float64), ('freespeed', np.float64),
+        ('od_o', np.int32), ('od_d', np.int32), ('od_flow', np.float64)]
+
+
+class CompactGraph:
+    """Immutable array-backed graph with polynomial delays (struct of arrays)
+
+    Links are described by arrays of their start and end nodes (0-based),
+    routes, ffdelay, slope, coef (numlinks, degree), capacity, length and
+    freespeed (nan if None), ODs by od_o, od_d (0-based) and od_flow. The
+    forward (backward) star of node i is fwdlinks[fwdptr[i]:fwdptr[i+1]]
+    (bwdlinks[bwdptr[i]:bwdptr[i+1]]). Arrays are read-only and shared by
+    the graphs made by replace(), so that a scenario is a cheap snapshot.
+    """
+    def __init__(self, arrays, delaytype='Polynomial', description=None):
+        for key, dtype in FIELDS:
+            value = np.asarray(arrays[key], dtype=dtype).view()
+            value.flags.writeable = False
+            setattr(self, key, value)
+        if self.coef.ndim == 1: self.coef = self.coef.reshape((-1,1))
+        self.delaytype = delaytype
+        self.description = description
+        self.numnodes = self.nodes_position.shape[0]
+        self.numlinks = self.start.size
+        self.numODs = self.od_o.size
+        self.numpaths = 0
+        n = self.numnodes
+        self.fwdlinks = np.argsort(self.start, kind='mergesort').astype(np.int32)
+        self.fwdptr = np.searchsorted(self.start[self.fwdlinks], np.arange(n+1)).astype(np.int32)
+        self.bwdlinks = np.argsort(self.end, kind='mergesort').astype(np.int32)
+        self.bwdptr = np.searchsorted(self.end[self.bwdlinks], np.arange(n+1)).astype(np.int32)
+
+    def arrays(self):
+        """Dict of the arrays of the graph (views, not copies)"""
+        return dict([(key, getattr(self, key)) for key, dtype in FIELDS])
+
+    def replace(self, **arrays):
+        """New CompactGraph with some arrays replaced (e.g. capacity, ffdelay,
+        coef of a scenario), sharing all other arrays with this graph"""
+        new = self.arrays()
+        new.update(arrays)
+        graph = CompactGraph(new, self.delaytype, self.description)
+        # the shortest-path engine is shared if the topology and ODs are unchanged
+        if hasattr(self, 'spengine') and not set(arrays) & set(['start', 'end', 'od_o', 'od_d', 'od_flow']):
+            graph.spengine = self.spengine
+        return graph
+
+    def link_keys(self):
+        """Keys (startnode, endnode, route) of the links of Graph, in order"""
+        return zip((self.start+1).tolist(), (self.end+1).tolist(), self.route.tolist())
+
+    def get_ffdelays(self):
+        """Get ffdelays in a column cvxopt matrix"""
+        return matrix(self.ffdelay)
+
+    def get_slopes(self):
+        """Get slopes in a column cvxopt matrix"""
+        return matrix(self.slope)
+
+    def get_coefs(self):
+        """Get coefficients of the polynomial delay functions in cvxopt.matrix"""
+        return matrix(self.coef)
+
+    def update_linkflows_linkdelays(self, linkflows):
+        logging.error('CompactGraph is immutable, link flows are not stored (use to_graph())')
+
+    def update_pathdelays(self):
+        pass
+
+    def to_graph(self):
+        """Convert into a Graph object"""
+        def value(x):
+            return None if np.isnan(x) else x
+        links = []
+        for (startnode, endnode, route), ffdelay, slope, coef, capacity, length, freespeed in zip(
+                self.link_keys(), self.ffdelay, self.slope, self.coef, self.capacity, self.length, self.freespeed):
+            links.append((startnode, endnode, route, ffdelay, (ffdelay, slope, list(coef)),
+                value(capacity), value(length), value(freespeed)))
+        nodes = [None if np.all(np.isnan(position)) else tuple(position) for position in self.nodes_position]
+        ods = zip((self.od_o+1).tolist(), (self.od_d+1).tolist(), self.od_flow.tolist())
+        return g.create_graph_from_list(nodes, links, self.delaytype, ods, self.description)
+
+
+def compact_graph(graph):
+    """Create a CompactGraph from a Graph with polynomial delays"""
+    type = graph.links.values()[0].delayfunc.type
+    if type != 'Polynomial': logging.error('Delay functions must be polynomial'); return
+    nlink = graph.numlinks
+    degree = max([link.delayfunc.degree for link in graph.links.itervalues()])
+    arrays = dict([(key, np.zeros(nlink)) for key in
+        ['start', 'end', 'route', 'ffdelay', 'slope', 'capacity', 'length', 'freespeed']])
+    arrays['coef'] = np.zeros((nlink, degree))
+    positions = [graph.nodes_position[i] for i in xrange(1, graph.numnodes+1)]
+    arrays['nodes_position'] = np.array([(np.nan, np.nan) if position is None else position
+        for position in positions], dtype=float).reshape((graph.numnodes, -1))
+    for (startnode, endnode, route), link_indx in graph.indlinks.iteritems():
+        link = graph.links[(startnode, endnode, route)]
+        arrays['start'][link_indx], arrays['end'][link_indx] = startnode-1, endnode-1
+        arrays['route'][link_indx] = route
+        arrays['ffdelay'][link_indx] = link.delayfunc.ffdelay
+        arrays['slope'][link_indx] = link.delayfunc.slope
+        arrays['coef'][link_indx, :link.delayfunc.degree] = link.delayfunc.coef
+        for key in ['capacity', 'length', 'freespeed']:
+            value = getattr(link, key)
+            arrays[key][link_indx] = np.nan if value is None else value
+    ods = np.zeros((graph.numODs, 3))
+    for (origin, destination), od_indx in graph.indods.iteritems():
+        ods[od_indx] = (origin-1, destination-1, graph.ODs[(origin, destination)].flow)
+    arrays['od_o'], arrays['od_d'], arrays['od_flow'] = ods[:,0], ods[:,1], ods[:,2]
+    return CompactGraph(arrays, type, graph.description)
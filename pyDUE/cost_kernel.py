@@ -0,0 +1,96 @@
+import numpy as np
+from cvxopt import matrix, spmatrix
+import logging
+from compact_graph import CompactGraph
+
+
+class PolyCostKernel:
+    """Array-backed polynomial link costs for all links of a graph
+    delay_i(x) = ffdelay[i] + sum_{k=1}^degree coef[i,k-1]*x^k
+    obj_i(x) = ffdelay[i]*x + sum_{k=1}^degree coef[i,k-1]*x^(k+1)/(k+1)
+    (same as PolyDelay, evaluated for all links at once)"""
+    def __init__(self, ffdelay, coef):
+        self.ffdelay = np.ascontiguousarray(ffdelay, dtype=float).ravel()
+        coef = np.asarray(coef, dtype=float)
+        if coef.ndim == 1: coef = coef.reshape((-1,1))
+        self.numlinks, self.degree = coef.shape
+        # coefficients stored highest power first for Horner's scheme
+        self.coef = np.ascontiguousarray(coef[:,::-1])
+        self.objcoef = np.ascontiguousarray(self.coef/np.arange(self.degree+1., 1., -1.))
+        self.dcoef = np.ascontiguousarray(self.coef[:,:-1]*np.arange(self.degree, 1., -1.))
+
+    def _horner(self, c, x):
+        res = np.zeros(x.shape)
+        for j in xrange(c.shape[1]):
+            res += c[:,j]
+            res *= x
+        return res
+
+    def compute_delay(self, flow, links=None):
+        """Compute link delays (gradient of the objective), only of links
+        (indices) if given"""
+        x = as_flow_array(flow)
+        if links is None: return self.ffdelay + self._horner(self.coef, x)
+        return self.ffdelay[links] + self._horner(self.coef[links], x[links])
+
+    def compute_ddelay(self, flow, links=None):
+        """Compute derivatives of link delays (diagonal of the Hessian), only
+        of links (indices) if given"""
+        x = as_flow_array(flow)
+        if links is None: return self.coef[:,-1] + self._horner(self.dcoef, x)
+        return self.coef[links,-1] + self._horner(self.dcoef[links], x[links])
+
+    def compute_linkobj(self, flow):
+        """Compute objective func of minimization for each link"""
+        x = as_flow_array(flow)
+        return (self.ffdelay + self._horner(self.objcoef, x))*x
+
+    def compute_obj(self, flow):
+        """Compute objective func of minimization, summed over all links"""
+        return np.sum(self.compute_linkobj(flow))
+
+    def line_search(self, flow, direction, tol=1e-12, niter=100):
+        """Step in [0,1] minimizing the objective along flow+step*direction
+
+        The directional derivative sum_i delay_i(flow+step*direction)*direction_i
+        is a polynomial increasing in step; its root is found by Newton's method
+        safeguarded by bisection on a bracket of [0,1]."""
+        x, p = as_flow_array(flow), as_flow_array(direction)
+        def derivs(step):
+            y = x + step*p
+            return np.dot(self.compute_delay(y), p), np.dot(self.compute_ddelay(y), p*p)
+        g0, h = derivs(0.)
+        if g0 >= 0.: return 0.
+        if derivs(1.)[0] <= 0.: return 1.
+        lo, hi, step, g = 0., 1., 0., g0
+        for k in xrange(niter):
+            newstep = step - g/h if h > 0. else -1.
+            if not lo < newstep < hi: newstep = 0.5*(lo+hi)
+            step = newstep
+            g, h = derivs(step)
+            if g > 0.: hi = step
+            else: lo = step
+            if abs(g) <= tol*abs(g0) or hi-lo <= tol: break
+        return step
+
+
+def as_flow_array(flow):
+    """Return link flows (cvxopt or numpy column) as a 1-D float array"""
+    if isinstance(flow, spmatrix): flow = matrix(flow)
+    return np.asarray(flow, dtype=float).ravel()
+
+
+def create_cost_kernel(graph):
+    """Create a PolyCostKernel from the links of graph, indexed by graph.indlinks
+    (or from the arrays of a CompactGraph)"""
+    if isinstance(graph, CompactGraph): return PolyCostKernel(graph.ffdelay, graph.coef)
+    type = graph.links.values()[0].delayfunc.type
+    if type != 'Polynomial': logging.error('Delay functions must be polynomial'); return
+    n = graph.numlinks
+    degree = max([link.delayfunc.degree for link in graph.links.itervalues()])
+    ffdelay, coef = np.zeros(n), np.zeros((n, degree))
+    for id,link in graph.links.iteritems():
+        i = graph.indlinks[id]
+        ffdelay[i] = link.delayfunc.ffdelay
+        coef[i,:link.delayfunc.degree] = link.delayfunc.coef
+    return PolyCostKernel(ffdelay, coef)
@@ -0,0 +1,62 @@
+import numpy as np
+from cost_kernel import create_cost_kernel, as_flow_array
+from compact_graph import CompactGraph, compact_graph
+import ue_solver as ue
+
+
+def ue_linkflows(graph, e, solver=None):
+    """UE link flows of graph with solver (ue.solver_gp if None), any solver
+    of ue_solver accepting e and trace; raise a RuntimeError if the solver
+    stops (niter) above the relative gap e"""
+    if solver is None: solver = ue.solver_gp
+    gaps = []
+    linkflows = solver(graph, e=e, trace=gaps)
+    if isinstance(linkflows, tuple): linkflows = linkflows[1]
+    if not gaps or gaps[-1] >= e:
+        raise RuntimeError('UE not converged: relative gap {} above {}'.format(gaps[-1] if gaps else None, e))
+    return as_flow_array(linkflows)
+
+
+def linear_response(graph, linkflows, weights, step=1e-3, e=1e-10, solver=None):
+    """Gradient of sum_a weights_a*x_a at UE with respect to additive changes
+    of the link delays (implicit function of the UE conditions)
+
+    The Jacobian J of the UE link flows with respect to additive changes c of
+    the link delays is symmetric (J is the Hessian of min_x Tf(x)+c'*x), so
+    that the gradient J*weights is the derivative of the UE link flows along
+    c = weights, here by central differences of two UE solutions with the
+    link delays shifted by +-eps*weights (eps of step times the mean link
+    delay). First-order changes of weights'*x for any number of changes g of
+    the link delays then follow from (J*weights)'*g without further UE.
+
+    Parameters
+    ----------
+    graph: graph object (or CompactGraph) with polynomial delays
+    linkflows: UE link flows (scale of the shifts)
+    weights: weights of the link flows (nlink,)
+    step: relative size of the shifts of the link delays
+    e: relative gap of the UE solutions (tight, the differences are small)
+    solver: UE solver as for ue_linkflows (ue.solver_gp if None)
+
+    Return value
+    ------------
+    gradient: J*weights (nlink,)
+    """
+    if not isinstance(graph, CompactGraph): graph = compact_graph(graph)
+    x = as_flow_array(linkflows)
+    weights = np.asarray(weights, dtype=float).ravel()
+    if not np.any(weights): return np.zeros(weights.size)
+    eps = step*np.mean(create_cost_kernel(graph).compute_delay(x))/np.max(np.abs(weights))
+    shifted = [ue_linkflows(graph.replace(ffdelay=graph.ffdelay+sign*eps*weights), e, solver)
+        for sign in (1., -1.)]
+    return (shifted[0]-shifted[1])/(2.*eps)
+
+
+def total_delay_gradient(graph, linkflows, step=1e-3, e=1e-10, solver=None):
+    """Gradient of the total delay sum_a x_a*delay_a(x_a) at UE with respect
+    to additive changes of the link delays: x + J*(x*ddelay), as the changes
+    of the flows at UE leave sum_a delay_a*x_a unchanged (demands are fixed
+    and all used paths of an OD have the same delay)"""
+    x = as_flow_array(linkflows)
+    marginal = x*create_cost_kernel(graph).compute_ddelay(x)
+    return x + linear_response(graph, linkflows, marginal, step, e, solver)
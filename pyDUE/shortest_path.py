@@ -0,0 +1,226 @@
+import numpy as np
+from scipy import sparse
+from scipy.sparse import csgraph
+import logging
+from compact_graph import CompactGraph
+
+# number of origins solved per call to csgraph.dijkstra (bounds memory of the
+# (norigin, nnode) distance and predecessor arrays)
+ORIGIN_BLOCK = 256
+
+
+class ShortestPathEngine:
+    """Compressed-sparse-row adjacency of a graph for repeated all-or-nothing loading
+
+    The adjacency is built once per topology; link costs are updated in place
+    and shortest-path trees are computed with one-to-all Dijkstra searches for
+    all distinct origins of graph.ODs. Parallel links (same start and end
+    nodes) share one CSR entry carrying the cost of the cheapest of them.
+    Nodes are indexed by id-1 and links by graph.indlinks (graph can also be
+    a CompactGraph).
+    """
+    def __init__(self, graph):
+        self.numnodes = graph.numnodes
+        self.numlinks = graph.numlinks
+        self.numODs = graph.numODs
+        n, m = self.numnodes, self.numlinks
+        if isinstance(graph, CompactGraph):
+            start, end = graph.start.astype(int), graph.end.astype(int)
+            ods = np.column_stack((graph.od_o, graph.od_d, graph.od_flow)).reshape((-1,3))
+        else:
+            start, end = np.zeros(m, dtype=int), np.zeros(m, dtype=int)
+            for (u,v,route), i in graph.indlinks.iteritems():
+                start[i], end[i] = u-1, v-1
+            ods = np.array([(od.o-1, od.d-1, od.flow) for od in graph.ODs.itervalues()]).reshape((-1,3))
+        self.linkstart = start
+        # CSR entries are the distinct (start, end) pairs sorted by key
+        linkkey = start*n + end
+        self.pairkey, self.link2pair = np.unique(linkkey, return_inverse=True)
+        npair = self.pairkey.size
+        pairstart, pairend = self.pairkey // n, self.pairkey % n
+        indptr = np.zeros(n+1, dtype=int)
+        np.cumsum(np.bincount(pairstart, minlength=n), out=indptr[1:])
+        self.adjacency = sparse.csr_matrix((np.ones(npair), pairend, indptr), shape=(n,n))
+        self.multilink = npair < m
+        # link carrying the flow of each CSR entry
+        self.pair2link = np.zeros(npair, dtype=int)
+        self.pair2link[self.link2pair] = np.arange(m)
+        # OD pairs grouped by origin
+        order = np.argsort(ods[:,0], kind='mergesort')
+        ods = ods[order]
+        self.origins, odptr = np.unique(ods[:,0].astype(int), return_index=True)
+        self.odptr = np.append(odptr, ods.shape[0])
+        self.oddest = ods[:,1].astype(int)
+        self.odflow = ods[:,2]
+
+    def matches(self, graph):
+        """Check if the engine was built for the topology and ODs of graph"""
+        return (self.numnodes, self.numlinks, self.numODs) == (graph.numnodes, graph.numlinks, graph.numODs)
+
+    def update_costs(self, linkcosts):
+        """Update link costs (indexed by graph.indlinks) in place"""
+        linkcosts = np.asarray(linkcosts, dtype=float).ravel()
+        if not self.multilink:
+            self.adjacency.data[self.link2pair] = linkcosts
+            return
+        # cheapest link of each group of parallel links
+        order = np.lexsort((linkcosts, self.link2pair))
+        first = np.ones(self.numlinks, dtype=bool)
+        first[1:] = self.link2pair[order[1:]] != self.link2pair[order[:-1]]
+        self.pair2link[self.link2pair[order[first]]] = order[first]
+        self.adjacency.data[:] = linkcosts[self.pair2link]
+
+    def shortest_path_trees(self, origins):
+        """Dijkstra shortest-path trees from the given (0-based) origins
+
+        Return value
+        ------------
+        dist: array (len(origins), numnodes) of shortest distances
+        inlink: array (len(origins), numnodes) of the link entering each node
+            in the tree (-1 for origins and unreachable nodes)
+        """
+        dist, pred = csgraph.dijkstra(self.adjacency, directed=True, indices=origins,
+                return_predecessors=True)
+        inlink = -np.ones(pred.shape, dtype=int)
+        mask = pred >= 0
+        nodes = np.nonzero(mask)[1]
+        pair = np.searchsorted(self.pairkey, pred[mask]*self.numnodes + nodes)
+        inlink[mask] = self.pair2link[pair]
+        return dist, inlink
+
+    def all_or_nothing(self, linkcosts=None):
+        """Load all OD flows on shortest paths, return link flows as a 1-D array
+
+        One shortest-path tree is computed per distinct origin; the demands to
+        all its destinations are accumulated from the leaves to the origin
+        (reverse topological order of the tree), so that each tree link is
+        loaded once with the total flow passing through it.
+        """
+        if linkcosts is not None: self.update_costs(linkcosts)
+        linkflows = np.zeros(self.numlinks)
+        for b in xrange(0, self.origins.size, ORIGIN_BLOCK):
+            origins = self.origins[b:b+ORIGIN_BLOCK]
+            dist, inlink = self.shortest_path_trees(origins)
+            odrows = np.repeat(np.arange(origins.size), np.diff(self.odptr[b:b+origins.size+1]))
+            odslice = slice(self.odptr[b], self.odptr[b+origins.size])
+            linkflows += self.load_trees(inlink, odrows, self.oddest[odslice], self.odflow[odslice])
+        return linkflows
+
+    def load_trees(self, inlink, odrows, oddest, odflow):
+        """Load demands on shortest-path trees
+
+        Parameters
+        ----------
+        inlink: array (ntree, numnodes) of tree links from shortest_path_trees
+        odrows, oddest, odflow: tree (row of inlink), destination and flow of each OD
+
+        Return value
+        ------------
+        linkflows: 1-D array of link flows summed over all trees
+        """
+        ntree, n = inlink.shape
+        inlink = inlink.ravel()
+        intree = inlink >= 0
+        unreachable = inlink[odrows*n+oddest] < 0
+        if np.any(unreachable):
+            for k, v in zip(odrows[unreachable], oddest[unreachable]):
+                logging.error('no path to node {} in shortest-path tree {}'.format(v+1, k))
+        # parent of each (tree, node) in flattened indexation (roots point to themselves)
+        parent = np.arange(ntree*n)
+        parent[intree] = (parent[intree]//n)*n + self.linkstart[inlink[intree]]
+        # depth of each node in its tree by pointer jumping
+        depth, anc = intree.astype(int), parent
+        while True:
+            depth, anc = depth + depth[anc], anc[anc]
+            if np.array_equal(anc, anc[anc]): break
+        # accumulate node loads level by level from the deepest nodes
+        load = np.bincount(odrows*n+oddest, weights=odflow, minlength=ntree*n)
+        load[np.logical_not(intree)] = 0.
+        order = np.argsort(-depth, kind='mergesort')
+        levels = np.append(0, np.cumsum(np.bincount(depth)[::-1]))
+        for a, b in zip(levels[:-2], levels[1:-1]):
+            nodes = order[a:b]
+            np.add.at(load, parent[nodes], load[nodes])
+        return np.bincount(inlink[intree], weights=load[intree], minlength=self.numlinks)
+
+
+def get_spengine(graph):
+    """Get the ShortestPathEngine cached on graph, (re)built if the topology
+    changed (cached on the base graph of a GraphOverlay, whose topology is
+    that of the base, so that all scenarios of a graph share one engine)"""
+    while getattr(graph, 'base', None) is not None: graph = graph.base
+    engine = getattr(graph, 'spengine', None)
+    if engine is None or not engine.matches(graph):
+        engine = ShortestPathEngine(graph)
+        graph.spengine = engine
+    return engine
+
+
+class PathSet:
+    """Paths of the OD pairs of a ShortestPathEngine generated from shortest-path
+    trees (column generation), stored in compact arrays
+
+    The links of path k are pathlinks[pathptr[k]:pathptr[k+1]] (indexed by
+    graph.indlinks, from origin to destination), pathod[k] is its OD pair
+    (index in engine.oddest) and flow[k] its flow. incidence is the sparse
+    (numlinks, numpaths) link-path incidence matrix.
+    """
+    def __init__(self, engine):
+        self.engine = engine
+        # tree (origin) of each OD pair
+        self.odorigin = np.repeat(np.arange(engine.origins.size), np.diff(engine.odptr))
+        self.pathod = np.zeros(0, dtype=int)
+        self.pathptr = np.zeros(1, dtype=int)
+        self.pathlinks = np.zeros(0, dtype=int)
+        self.flow = np.zeros(0)
+        self.index = {}
+        self.incidence = sparse.csc_matrix((engine.numlinks, 0))
+
+    @property
+    def numpaths(self):
+        return self.pathod.size
+
+    def links(self, k):
+        """Links of path k"""
+        return self.pathlinks[self.pathptr[k]:self.pathptr[k+1]]
+
+    def add_tree_paths(self, ods, inlink):
+        """Add the paths of ods (indices in engine.oddest) on their shortest-path
+        trees, return the indices of the paths (existing paths are not duplicated)
+
+        Parameters
+        ----------
+        ods: OD pairs, all with an origin in the rows of inlink
+        inlink: dict of 1-D arrays of tree links (rows of shortest_path_trees)
+            keyed by the origin (index in engine.origins)
+        """
+        indices = np.zeros(len(ods), dtype=int)
+        newlinks, newods = [], []
+        for i, od in enumerate(ods):
+            tree, v = inlink[self.odorigin[od]], self.engine.oddest[od]
+            links = []
+            while tree[v] >= 0:
+                links.append(tree[v])
+                v = self.engine.linkstart[tree[v]]
+            key = (od, tuple(links[::-1]))
+            if key not in self.index:
+                self.index[key] = self.numpaths + len(newods)
+                newlinks.append(key[1]); newods.append(od)
+            indices[i] = self.index[key]
+        if newods:
+            lengths = [len(links) for links in newlinks]
+            self.pathptr = np.append(self.pathptr, self.pathptr[-1] + np.cumsum(lengths))
+            self.pathlinks = np.append(self.pathlinks, np.concatenate(newlinks).astype(int))
+            self.pathod = np.append(self.pathod, newods)
+            self.flow = np.append(self.flow, np.zeros(len(newods)))
+            self.incidence = sparse.csc_matrix((np.ones(self.pathlinks.size), self.pathlinks, self.pathptr),
+                    shape=(self.engine.numlinks, self.numpaths))
+        return indices
+
+    def linkflows(self):
+        """Link flows of the path flows"""
+        return self.incidence.dot(self.flow)
+
+    def costs(self, linkcosts):
+        """Path costs from link costs"""
+        return self.incidence.T.dot(linkcosts)
@@ -0,0 +1,90 @@
+import numpy as np
+from cvxopt import matrix, spmatrix
+from scipy import sparse
+from scipy.sparse.linalg import splu
+
+# Regularization constant (as in kktsolver).
+REG_EPS = 1e-9
+
+
+def to_scipy(M):
+    """Convert a cvxopt matrix or spmatrix into a scipy.sparse csc_matrix"""
+    if isinstance(M, spmatrix):
+        return sparse.csc_matrix((np.array(M.V).ravel(), (np.array(M.I).ravel(), np.array(M.J).ravel())),
+                shape=M.size)
+    return sparse.csc_matrix(np.array(M))
+
+
+def get_sparse_kktsolver(G, dims, A, F, nlink):
+    """Returns a kktsolver for solvers.cp (as get_kktsolver) using a sparse LU
+    factorization, for the UE programs of ue_solver.solver (see kkt_sparse)"""
+    factor = kkt_sparse(G, dims, A, nlink)
+    def kktsolver(x, z, W):
+        f, Df, H = F(x, z)
+        return factor(W, H)
+    return kktsolver
+
+
+def kkt_sparse(G, dims, A, nlink):
+    """
+    Solution of KKT equations by a sparse LU factorization, for programs
+    whose variables are the link flows x_k (nlink each) of p destinations, with
+    an objective of the total link flows l = sum_k x_k only, so that
+
+        H = ones((p,p)) kron diag(h)
+
+    with h the second derivatives of the objective w.r.t. l (objective_poly,
+    objective_hyper, objective_hyper_SO), and only linear inequalities
+    (dims['l']) and no nonlinear ones.
+
+    Returns a function that (1) computes the sparse LU factorization of
+
+        [ 0           A'   G'*W^{-1}    U*diag(h) ]
+        [ A           0    0            0         ]
+        [ W^{-T}*G    0   -I            0         ]
+        [ U'          0    0           -I         ]
+
+    given H and W, where U = ones((p,1)) kron I (so that H = U*diag(h)*U' is
+    never formed and the last block row defines l = U'*ux), with the same
+    regularization as kkt_ldl, and (2) returns a function for solving
+
+        [ H     A'   G'    ]   [ ux ]   [ bx ]
+        [ A     0    0     ] * [ uy ] = [ by ].
+        [ G     0   -W'*W  ]   [ uz ]   [ bz ]
+
+    The factorization has O(nnz(A)+nnz(G)) nonzeros instead of the
+    (n+p+N)^2 entries of kkt_ldl.
+    """
+    if dims['q'] or dims['s']: raise ValueError('kkt_sparse only supports linear inequalities')
+    N, P, L = G.size[1], A.size[0], G.size[0]
+    p = N // nlink
+    Ga, Aa = to_scipy(G), to_scipy(A)
+    U = sparse.kron(np.ones((p,1)), sparse.identity(nlink), format='csc')
+
+    def factor(W, H):
+        # diagonal of the first block of H (strided linear indexing of the cvxopt matrix)
+        n = H.size[0]
+        h = np.array(matrix(H[:nlink*(n+1):n+1])).ravel()
+        d = np.array(W['d']).ravel()
+        WG = sparse.diags(1./d).dot(Ga)
+        K = sparse.bmat([
+                [REG_EPS*sparse.identity(N), Aa.T, WG.T, U.dot(sparse.diags(h))],
+                [Aa, -REG_EPS*sparse.identity(P), None, None],
+                [WG, None, -sparse.identity(L), None],
+                [U.T, None, None, -sparse.identity(nlink)]], format='csc')
+        # symmetric fill-reducing ordering (the KKT matrix is structurally symmetric)
+        lu = splu(K, permc_spec='MMD_AT_PLUS_A')
+
+        def solve(x, y, z):
+            # On entry, x, y, z contain bx, by, bz.  On exit, they contain
+            # the solution ux, uy, W*uz (as in kkt_ldl).
+            rhs = np.concatenate((np.array(x).ravel(), np.array(y).ravel(), np.array(z).ravel()/d,
+                    np.zeros(nlink)))
+            u = lu.solve(rhs)
+            x[:] = matrix(u[:N])
+            y[:] = matrix(u[N:N+P])
+            z[:] = matrix(u[N+P:N+P+L])
+
+        return solve
+
+    return factor
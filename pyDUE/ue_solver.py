@@ -10,12 +10,17 @@ solvers.options['reltol'] = 1e-7
 import rank_nullspace as rn
 from util import find_basis
 from kktsolver import get_kktsolver
+from sparse_kkt import get_sparse_kktsolver
 import networkx as nx
 import itertools
 import scipy.optimize as op
 from scipy.misc import factorial
 import copy
 from util import create_networkx_graph
+from cost_kernel import create_cost_kernel, as_flow_array
+from shortest_path import get_spengine, PathSet, ORIGIN_BLOCK
+from bush import BushTopology, OriginBush
+from compact_graph import CompactGraph
 import logging
 if logging.getLogger().getEffectiveLevel() >= logging.DEBUG:
     solvers.options['show_progress'] = False
@@ -39,8 +44,11 @@ def constraints(graph, rm_redundant = False):
     ds = [get_demands(graph, ind, id) for id,node in graph.nodes.items() if len(node.endODs) > 0]
     p = len(ds)
     m,n = C.size
-    Aeq, beq = spmatrix([], [], [], (p*m,p*n)), matrix(ds)
-    for k in range(p): Aeq[k*m:(k+1)*m, k*n:(k+1)*n] = C
+    # block diagonal with p blocks C
+    I, J = np.array(C.I).ravel(), np.array(C.J).ravel()
+    Aeq = spmatrix(list(C.V)*p, np.concatenate([I+k*m for k in range(p)]).tolist(),
+            np.concatenate([J+k*n for k in range(p)]).tolist(), (p*m,p*n))
+    beq = matrix(ds)
     return Aeq, beq
 
 
@@ -93,17 +101,15 @@ def linkpath_incidence(graph):
     G.add_nodes_from(graph.nodes.keys())
     G.add_edges_from([(key[0],key[1]) for key in graph.links.keys()])
     indcol = -1
-    # C = np.ones((nlink, npair*nlink))
-    entries, I, J = [], [], []
+    # COO triplets: links (u,v,1) of consecutive nodes of each path, as in add_path_from_nodes
+    I, J = [], []
     for OD in graph.ODs.itervalues():
         for nodes_on_path in nx.all_simple_paths(G, OD.o, OD.d):
             graph.add_path_from_nodes(nodes_on_path)
             indcol += 1
-            for u,v,route in graph.links.keys():
-                indrow = graph.indlinks[(u,v,route)]
-                if str([u,v])[1:-1] in str(nodes_on_path)[1:-1]:
-                    entries.append(1.0); I.append(indrow), J.append(indcol)
-    C = spmatrix(entries, I, J, (nlink,indcol+1))
+            I.extend([graph.indlinks[(u,v,1)] for u,v in zip(nodes_on_path[:-1], nodes_on_path[1:])])
+            J.extend([indcol]*(len(nodes_on_path)-1))
+    C = spmatrix(1.0, I, J, (nlink,indcol+1))
     return C
 
 
@@ -160,6 +166,21 @@ def get_demands(graph, ind, node_id):
     return d[ind]
 
 
+def block_hessian(h, p):
+    """Hessian of a function of l = sum_w x_w (p blocks of variables) as a sparse
+    matrix of p x p diagonal blocks diag(h) (p**2*n nonzeros)"""
+    n = h.size
+    blocks = np.arange(p)*n
+    I = (blocks[:,None,None] + np.arange(n)[None,None,:]) + np.zeros((1,p,1), dtype=int)
+    J = (blocks[None,:,None] + np.arange(n)[None,None,:]) + np.zeros((p,1,1), dtype=int)
+    return spmatrix(np.tile(h, p*p).tolist(), I.ravel().tolist(), J.ravel().tolist(), (p*n,p*n))
+
+
+def total_flows(x, n, p):
+    """Link flows l = sum_w x_w from a zero-copy NumPy view of x"""
+    return np.asarray(x).reshape((p,n)).sum(axis=0)
+
+
 def objective_poly(x, z, ks, p, w_obs=0.0, obs=None, l_obs=None, w_gap=1.0):
     """Objective function of UE program with polynomial delay functions
     f(x) = sum_i f_i(l_i) (+ 0.5*w_obs*||l[obs]-l_obs||^2)
@@ -177,25 +198,23 @@ def objective_poly(x, z, ks, p, w_obs=0.0, obs=None, l_obs=None, w_gap=1.0):
     """
     n, d = ks.size
     if x is None: return 0, matrix(1.0/p, (p*n,1))
-    l = matrix(0.0, (n,1))
-    for k in range(p): l += x[k*n:(k+1)*n]
-    f, Df, H = 0.0, matrix(0.0, (1,n)), matrix(0.0, (n,1))
-    for i in range(n):
-        tmp = matrix(np.power(l[i],range(d+1)))
-        f += ks[i,:] * tmp[1:]
-        Df[i] = ks[i,:] * mul(tmp[:-1], matrix(range(1,d+1)))
-        H[i] = ks[i,1:] * mul(tmp[:-2], matrix(range(2,d+1)), matrix(range(1,d)))
+    l = total_flows(x, n, p)
+    K = np.asarray(ks)
+    powers = np.power.outer(l, np.arange(d+1))
+    f = np.sum(K*powers[:,1:])
+    Df = np.sum(K*powers[:,:-1]*np.arange(1,d+1), axis=1)
+    H = np.sum(K[:,1:]*powers[:,:-2]*(np.arange(2,d+1)*np.arange(1,d)), axis=1)
     if w_gap != 1.0: f, Df, H = w_gap*f, w_gap*Df, w_gap*H
     
     if w_obs > 0.0:
-        num_obs, e = len(obs), l[obs]-l_obs
-        f += 0.5*w_obs*e.T*e
-        Df += w_obs*spmatrix(e, [0]*num_obs, obs, (1,n))
-        H += spmatrix([w_obs]*num_obs, obs, [0]*num_obs, (n,1))
+        e = l[obs]-np.asarray(l_obs).ravel()
+        f += 0.5*w_obs*np.dot(e, e)
+        Df[obs] += w_obs*e
+        H[obs] += w_obs
     
-    Df = matrix([[Df]]*p)
+    f, Df = matrix(f, (1,1)), matrix(np.tile(Df, p), (1,p*n))
     if z is None: return f, Df
-    return f, Df, matrix([[spdiag(z[0] * H)]*p]*p)
+    return f, Df, block_hessian(z[0]*H, p)
 
 
 def objective_hyper(x, z, ks, p):
@@ -212,17 +231,15 @@ def objective_hyper(x, z, ks, p):
     """
     n = ks.size[0]
     if x is None: return 0, matrix(1.0/p, (p*n,1))
-    l = matrix(0.0, (n,1))
-    for k in range(p): l += x[k*n:(k+1)*n]
-    f, Df, H = 0.0, matrix(0.0, (1,n)), matrix(0.0, (n,1))
-    for i in range(n):
-        tmp = 1.0/(ks[i,2]-l[i])
-        f += ks[i,0]*l[i] - ks[i,1]*np.log(max(ks[i,2]-l[i], 1e-13))
-        Df[i] = ks[i,0] + ks[i,1]*tmp
-        H[i] = ks[i,1]*tmp**2
-    Df = matrix([[Df]]*p)
+    l = total_flows(x, n, p)
+    K = np.asarray(ks)
+    tmp = 1.0/(K[:,2]-l)
+    f = np.sum(K[:,0]*l - K[:,1]*np.log(np.maximum(K[:,2]-l, 1e-13)))
+    Df = K[:,0] + K[:,1]*tmp
+    H = K[:,1]*tmp**2
+    f, Df = matrix(f, (1,1)), matrix(np.tile(Df, p), (1,p*n))
     if z is None: return f, Df
-    return f, Df, sparse([[spdiag(z[0] * H)]*p]*p)
+    return f, Df, block_hessian(z[0]*H, p)
 
 
 def objective_hyper_SO(x, z, ks, p):
@@ -239,17 +256,15 @@ def objective_hyper_SO(x, z, ks, p):
     """
     n = ks.size[0]
     if x is None: return 0, matrix(1.0/p, (p*n,1))
-    l = matrix(0.0, (n,1))
-    for k in range(p): l += x[k*n:(k+1)*n]
-    f, Df, H = 0.0, matrix(0.0, (1,n)), matrix(0.0, (n,1))
-    for i in range(n):
-        tmp = 1.0/(ks[i,2]-l[i])
-        f += ks[i,0]*l[i] + ks[i,1]*l[i]*tmp
-        Df[i] = ks[i,0] + ks[i,1]*tmp + ks[i,1]*l[i]*tmp**2
-        H[i] = 2.0*ks[i,1]*tmp**2 + 2.0*ks[i,1]*l[i]*tmp**3
-    Df = matrix([[Df]]*p)
+    l = total_flows(x, n, p)
+    K = np.asarray(ks)
+    tmp = 1.0/(K[:,2]-l)
+    f = np.sum(K[:,0]*l + K[:,1]*l*tmp)
+    Df = K[:,0] + K[:,1]*tmp + K[:,1]*l*tmp**2
+    H = 2.0*K[:,1]*tmp**2 + 2.0*K[:,1]*l*tmp**3
+    f, Df = matrix(f, (1,1)), matrix(np.tile(Df, p), (1,p*n))
     if z is None: return f, Df
-    return f, Df, matrix([[spdiag(z[0] * H)]*p]*p)
+    return f, Df, block_hessian(z[0]*H, p)
 
 
 def get_data(graph):
@@ -261,7 +276,7 @@ def get_data(graph):
     return Aeq, beq, ffdelays, parameters, type
 
 
-def solver(graph=None, update=False, full=False, data=None, SO=False):
+def solver(graph=None, update=False, full=False, data=None, SO=False, kkt='dense'):
     """Find the UE link flow
     
     Parameters
@@ -270,7 +285,11 @@ def solver(graph=None, update=False, full=False, data=None, SO=False):
     update: if update==True: update link flows and link,path delays in graph
     full: if full=True, also return x (link flows per OD pair)
     data: (Aeq, beq, ffdelays, parameters, type) from get_data(graph)
+    kkt: 'dense' (LDL factorization of kktsolver) or 'sparse' (sparse LU
+        factorization of sparse_kkt, for larger networks)
+    (a CompactGraph is converted into a Graph first)
     """
+    if isinstance(graph, CompactGraph): graph = graph.to_graph()
     if data is None: data = get_data(graph)
     Aeq, beq, ffdelays, pm, type = data
     n = len(ffdelays)
@@ -285,7 +304,12 @@ def solver(graph=None, update=False, full=False, data=None, SO=False):
         else:
             def F(x=None, z=None): return objective_hyper(x, z, matrix([[ffdelays-div(pm[:,0],pm[:,1])], [pm]]), p)
     dims = {'l': p*n, 'q': [], 's': []}
-    x = solvers.cp(F, G=A, h=b, A=Aeq, b=beq, kktsolver=get_kktsolver(A, dims, Aeq, F))['x']
+    if kkt == 'sparse': kktsolver = get_sparse_kktsolver(A, dims, Aeq, F, n)
+    else: kktsolver = get_kktsolver(A, dims, Aeq, F)
+    sol = solvers.cp(F, G=A, h=b, A=Aeq, b=beq, kktsolver=kktsolver)
+    if sol['status'] != 'optimal':
+        logging.error('cvxopt solver status is {}, link flows are not optimal'.format(sol['status']))
+    x = sol['x']
     linkflows = matrix(0.0, (n,1))
     for k in range(p): linkflows += x[k*n:(k+1)*n]
     
@@ -297,11 +321,56 @@ def solver(graph=None, update=False, full=False, data=None, SO=False):
     return linkflows
 
 
-def solver_fw(graph=None, update=False, full=False, data=None, SO=False, e=1e-4, niter=1e4, verbose=False, x0=None):
-    """Frank-Wolfe algorithm for UE according to Patriksson (1994)"""
-    nnode = len(graph.nodes.keys())
-    npair = len(graph.ODs.keys())
-    nlink = len(graph.links.keys())
+def fw_target(hess, x, y, s1=None, s2=None, step=None, algorithm='FW', delta=1e-4):
+    """Target point s of the search direction s-x of Frank-Wolfe algorithms,
+    conjugate and bi-conjugate FW according to Mitradjieva and Lindberg (2013)
+
+    Parameters
+    ----------
+    hess: diagonal of the Hessian of the objective at x
+    x: current link flows
+    y: all-or-nothing link flows at x
+    s1, s2: target points of the last two iterations (None if not available)
+    step: step size of the last iteration
+    algorithm: 'FW', 'CFW' or 'BFW'
+    delta: s stays at least delta (in convex combination) away from s1, s2
+
+    Return value
+    ------------
+    s: convex combination of y, s1 (and s2) such that s-x is conjugate (w.r.t.
+    the Hessian) to the last (two) search directions, y if no such point exists
+    """
+    if algorithm == 'FW' or s1 is None or step >= 1.-delta: return y
+    dfw = y - x
+    a = hess*(s1-x)
+    if algorithm == 'BFW' and s2 is not None:
+        b = hess*(step*s1 + (1.-step)*s2 - x)
+        lhs = np.array([[np.dot(a, s1-y), np.dot(a, s2-y)], [np.dot(b, s1-y), np.dot(b, s2-y)]])
+        rhs = -np.array([np.dot(a, dfw), np.dot(b, dfw)])
+        try:
+            beta = np.linalg.solve(lhs, rhs)
+            if np.all(np.isfinite(beta)) and np.all(beta >= 0.) and np.sum(beta) <= 1.-delta:
+                return y + beta[0]*(s1-y) + beta[1]*(s2-y)
+        except np.linalg.LinAlgError:
+            pass
+    # conjugate direction w.r.t. the last search direction only
+    den = np.dot(a, s1-y)
+    if den == 0.: return y
+    alpha = min(max(-np.dot(a, dfw)/den, 0.), 1.-delta)
+    return y + alpha*(s1-y)
+
+
+def solver_fw(graph=None, update=False, full=False, data=None, SO=False, e=1e-4, niter=1e4, verbose=False, x0=None,
+        algorithm='FW', trace=None):
+    """Frank-Wolfe algorithm for UE according to Patriksson (1994)
+
+    graph: Graph or CompactGraph
+    algorithm: 'FW' (Frank-Wolfe), 'CFW' (conjugate FW) or 'BFW' (bi-conjugate FW)
+    trace: if a list, the relative gap (Tf-LBD)/LBD of each iteration is appended
+    """
+    nnode = graph.numnodes
+    npair = graph.numODs
+    nlink = graph.numlinks
     nrow = nnode*npair
     ncol = nlink*npair
     # Step 0 (Initialization) Let f0 be a feasible solution to [TAP], LBD=0,
@@ -309,22 +378,14 @@ def solver_fw(graph=None, update=False, full=False, data=None, SO=False, e=1e-4,
     LBD = 0.
     if x0 is None: f = solver_kernal(graph)
     else: f = matrix(x0)
+    # link costs are evaluated for all links at once
+    kernel = create_cost_kernel(graph)
     def Tf_func(f):
-        linkflows = f
-        # linkflows = matrix(0.0, (nlink,1))
-        # for k in xrange(npair): linkflows += f[k*nlink:(k+1)*nlink]
-        return sum([graph.links[link_key].delayfunc.compute_obj(linkflows[link_indx]) for link_key, link_indx
-                in graph.indlinks.iteritems()])
+        return kernel.compute_obj(f)
     def dTf_func(f):
-        linkflows = f
-        # linkflows = matrix(0.0, (nlink,1))
-        # for k in xrange(npair): linkflows += f[k*nlink:(k+1)*nlink]
-        dTf = nlink*[0.0]
-        for link_key, link_indx in graph.indlinks.iteritems():
-            dTfi = graph.links[link_key].delayfunc.compute_delay(linkflows[link_indx])
-            dTf[link_indx] = dTfi
-        # dTf = matrix(npair*dTf)
-        return matrix(dTf)
+        return matrix(kernel.compute_delay(f))
+    # target points and step size of the last iterations (conjugate FW)
+    s1, s2, step = None, None, None
     for k in xrange(int(niter)):
         # Step 1 (Search direction generation) LP problem
         Tf = Tf_func(f)
@@ -332,8 +393,7 @@ def solver_fw(graph=None, update=False, full=False, data=None, SO=False, e=1e-4,
         #G = spmatrix(-1.0, range(ncol), range(ncol))
         #h = matrix(ncol*[0.0])
         #y = solvers.lp(dTf, G, h, Aeq, beq)['x']
-        y = solver_kernal(graph,f)
-        p = y - f
+        y = solver_kernal(graph, f, linkcosts=dTf)
         # Step 2 (Convergence check)
         def T_linear(x):
             res = Tf + dTf.T*(x-f)
@@ -341,16 +401,16 @@ def solver_fw(graph=None, update=False, full=False, data=None, SO=False, e=1e-4,
         LBD = np.maximum(LBD, T_linear(y))
         if verbose:
             print 'Iter #{}a: Tf={}, T_linear={}, LBD={}, e={}'.format(k+1, Tf, T_linear(y), LBD, e)
+        if trace is not None and LBD!=0: trace.append((Tf - LBD) / LBD)
         if LBD!=0 and (Tf - LBD) / LBD < e:
             break
-        # Step 3 (Line search)
-        #def T(step):
-            #obj, jac = Tf_func(f+step*p), dTf_func(f+step*p).T*p
-            #return [obj, np.array(jac[0])]
-        #step = op.minimize(T, x0=0.5, jac=True, bounds=[(0.,1.)]).x
-        def T(step):
-            return  Tf_func(f+step*p)
-        step = op.minimize(T, 0.5, method='L-BFGS-B', bounds=[(0., 1.)]).x[0]
+        # conjugate directions: target point s replaces y
+        fa = np.array(f).ravel()
+        s = fw_target(kernel.compute_ddelay(fa), fa, np.array(y).ravel(), s1, s2, step, algorithm)
+        s1, s2 = s, s1
+        p = matrix(s) - f
+        # Step 3 (Line search) exact for polynomial delays
+        step = kernel.line_search(fa, p)
         #step = 1./(k+2)
         # Step 4 (Update)
         f += step*p
@@ -373,7 +433,9 @@ def solver_fw(graph=None, update=False, full=False, data=None, SO=False, e=1e-4,
 
 def solver_fw_path(graph=None, update=False, full=False, data=None, SO=False, e=1e-4, niter=1e4, verbose=False):
     """Frank-Wolfe algorithm (with respect to path flow)
-       for UE according to Patriksson (1994)"""
+       for UE according to Patriksson (1994)
+       (a CompactGraph is converted into a Graph first)"""
+    if isinstance(graph, CompactGraph): graph = graph.to_graph()
     nnode = len(graph.nodes.keys())
     npair = len(graph.ODs.keys())
     nlink = len(graph.links.keys())
@@ -382,16 +444,11 @@ def solver_fw_path(graph=None, update=False, full=False, data=None, SO=False, e=
     LBD = 0.
     lpmtx = linkpath_incidence(graph)
     pf, pc, odc = solver_kernal_path(graph, lpmtx)
+    kernel = create_cost_kernel(graph)
     def Tf_func(pf):
-        linkflows = lpmtx*pf
-        return sum([graph.links[link_key].delayfunc.compute_obj(linkflows[link_indx])
-            for link_key, link_indx in graph.indlinks.iteritems()])
+        return kernel.compute_obj(lpmtx*pf)
     def dTh_func(pf):
-        linkflows = lpmtx*pf
-        dTf = matrix(0.0, (nlink,1))
-        for link_key, link_indx in graph.indlinks.iteritems():
-            dTfi = graph.links[link_key].delayfunc.compute_delay(linkflows[link_indx])
-            dTf[link_indx] = dTfi
+        dTf = matrix(kernel.compute_delay(lpmtx*pf))
         dTh = lpmtx.T*dTf
         return dTh
     for k in xrange(int(niter)):
@@ -410,9 +467,7 @@ def solver_fw_path(graph=None, update=False, full=False, data=None, SO=False, e=
         if LBD!=0 and (Tf - LBD) / LBD < e:
             break
         # Step 3 (Line search)
-        def linesearch(step):
-            return  Tf_func(pf+p*step[0])
-        step = op.minimize(linesearch, [0.5], method='L-BFGS-B', bounds=[(0., 1.)]).x[0]
+        step = kernel.line_search(lpmtx*pf, lpmtx*p)
         # step = 1./(k+2)    # MSA
         # Step 4 (Update)
         pf += step*p
@@ -431,10 +486,196 @@ def solver_fw_path(graph=None, update=False, full=False, data=None, SO=False, e=
         logging.info('Update link flows, delays in Graph.'); graph.update_linkflows_linkdelays(linkflows)
         logging.info('Update path delays in Graph.'); graph.update_pathdelays()
 
-    if full: return pathflows, linkflows, dTf_func(pf).T*pf
+    if full: return pathflows, linkflows, matrix(kernel.compute_delay(linkflows)).T*linkflows
     return pathflows, linkflows
 
 
+def solver_gp(graph=None, update=False, full=False, data=None, SO=False, e=1e-4, niter=1e4, verbose=False,
+        trace=None):
+    """Path-based gradient projection algorithm for UE according to
+    Jayakrishnan et al. (1994), with paths generated from shortest-path trees
+
+    Each iteration computes the shortest-path trees of all origins at current
+    link costs, adds the shortest paths not yet used to the path set of their
+    OD pair (column generation) and, origin by origin, shifts flow from the
+    other paths of each OD pair to its cheapest path with a Newton step
+    (diagonal Hessian of the symmetric difference of the two paths), scaled
+    by a Newton step along the shifts of all OD pairs of the origin. Link
+    flows and costs are updated after each origin.
+
+    e: tolerance on the relative gap (sum of link costs*flows - sum of OD
+    demands*shortest path costs) / sum of link costs*flows
+    trace: if a list, the relative gap of each iteration is appended
+
+    Return value
+    ------------
+    paths: PathSet with the path flows (paths.flow) of UE
+    linkflows: link flows of UE
+    (if full: also the total delay, as for solver_fw)
+    """
+    engine = get_spengine(graph)
+    kernel = create_cost_kernel(graph)
+    paths = PathSet(engine)
+    norigin = engine.origins.size
+    ods = np.arange(engine.oddest.size)
+    def all_trees():
+        dist, inlink = np.zeros(ods.size), {}
+        for b in xrange(0, norigin, ORIGIN_BLOCK):
+            block = np.arange(b, min(b+ORIGIN_BLOCK, norigin))
+            d, tree = engine.shortest_path_trees(engine.origins[block])
+            for i, o in enumerate(block):
+                inlink[o] = tree[i]
+                odslice = slice(engine.odptr[o], engine.odptr[o+1])
+                dist[odslice] = d[i, engine.oddest[odslice]]
+        return dist, inlink
+    # Step 0 (Initialization) all-or-nothing path flows at free-flow costs
+    x = np.zeros(engine.numlinks)
+    engine.update_costs(kernel.compute_delay(x))
+    dist, inlink = all_trees()
+    indices = paths.add_tree_paths(ods, inlink)
+    paths.flow[indices] = engine.odflow
+    x = paths.linkflows()
+    for k in xrange(int(niter)):
+        # Step 1 (Column generation) shortest paths at current costs
+        c = kernel.compute_delay(x)
+        engine.update_costs(c)
+        dist, inlink = all_trees()
+        # Step 2 (Convergence check)
+        cost = np.dot(c, x)
+        gap = (cost - np.dot(engine.odflow, dist)) / cost
+        if verbose:
+            print 'Iter #{}: Tf={}, gap={}, npath={}, e={}'.format(k+1, kernel.compute_obj(x), gap, paths.numpaths, e)
+        if trace is not None: trace.append(gap)
+        if gap < e:
+            break
+        paths.add_tree_paths(ods, inlink)
+        # Step 3 (Flow shift) origin by origin
+        order = np.argsort(paths.odorigin[paths.pathod], kind='mergesort')
+        bounds = np.searchsorted(paths.odorigin[paths.pathod[order]], np.arange(norigin+1))
+        for o in xrange(norigin):
+            sel = order[bounds[o]:bounds[o+1]]
+            inc = paths.incidence[:, sel]
+            pc, f, od = inc.T.dot(c), paths.flow[sel], paths.pathod[sel]
+            # cheapest path of each OD pair
+            first = np.lexsort((pc, od))
+            isbasic = np.ones(sel.size, dtype=bool)
+            isbasic[1:] = od[first[1:]] != od[first[:-1]]
+            basic = np.zeros(engine.oddest.size, dtype=int)
+            basic[od[first[isbasic]]] = first[isbasic]
+            b = basic[od]
+            # second derivative along the shift (links in only one of the two paths)
+            incb = inc[:, b]
+            dd = kernel.compute_ddelay(x)
+            h = inc.T.dot(dd) + incb.T.dot(dd) - 2.*inc.multiply(incb).T.dot(dd)
+            shift = np.zeros(sel.size)
+            move = (b != np.arange(sel.size)) & (f > 0.) & (h > 0.)
+            shift[move] = np.minimum(f[move], (pc[move]-pc[b[move]])/h[move])
+            df = -shift
+            np.add.at(df, b, shift)
+            # the OD pairs of an origin share links: Newton step along the joint shift
+            dx = inc.dot(df)
+            curv = np.dot(dd*dx, dx)
+            if curv <= 0.: continue
+            step = min(-np.dot(c, dx)/curv, 1.)
+            if step <= 0.: continue
+            paths.flow[sel] = f + step*df
+            x = x + step*dx
+            c = kernel.compute_delay(x)
+
+    linkflows = matrix(x)
+
+    if update:
+        logging.info('Update link flows, delays in Graph.'); graph.update_linkflows_linkdelays(linkflows)
+        logging.info('Update path flows, delays in Graph.'); update_paths(graph, paths)
+
+    if full: return paths, linkflows, matrix(kernel.compute_delay(x)).T*linkflows
+    return paths, linkflows
+
+
+def solver_bush(graph=None, update=False, full=False, data=None, SO=False, e=1e-4, niter=1e4, verbose=False,
+        x0=None, trace=None):
+    """Origin-based algorithm B for UE according to Dial (2006)
+
+    The flows of each origin are kept on an acyclic bush (OriginBush). Each
+    iteration updates the bush of each origin (unused links are dropped and
+    links shortening its longest paths are added) and shifts flow from the
+    longest to the shortest path segment to each of its nodes, with link
+    costs updated after each shift. Link delays must be positive.
+
+    e: tolerance on the relative gap, as for solver_gp
+    x0: link flows whose costs define the initial bushes (shortest-path trees),
+    free-flow costs if None. Origin flows cannot be recovered from link flows,
+    so the initial flows are still all-or-nothing
+    trace: if a list, the relative gap of each iteration is appended
+    """
+    engine = get_spengine(graph)
+    kernel = create_cost_kernel(graph)
+    topology = BushTopology(engine)
+    norigin = engine.origins.size
+    # Step 0 (Initialization) bushes are the shortest-path trees at the costs of x0
+    x = np.zeros(engine.numlinks)
+    engine.update_costs(kernel.compute_delay(x if x0 is None else as_flow_array(x0)))
+    bushes = []
+    for b in xrange(0, norigin, ORIGIN_BLOCK):
+        block = np.arange(b, min(b+ORIGIN_BLOCK, norigin))
+        dist, inlink = engine.shortest_path_trees(engine.origins[block])
+        for i, o in enumerate(block):
+            odslice = slice(engine.odptr[o], engine.odptr[o+1])
+            oddest, odflow = engine.oddest[odslice], engine.odflow[odslice]
+            flow = engine.load_trees(inlink[i:i+1], np.zeros(oddest.size, dtype=int), oddest, odflow)
+            bushes.append(OriginBush(topology, engine.origins[o], dist[i], inlink[i], flow))
+            x += flow
+    for k in xrange(int(niter)):
+        # Step 1 (Convergence check) relative gap
+        c = kernel.compute_delay(x)
+        engine.update_costs(c)
+        mincost = 0.
+        for b in xrange(0, norigin, ORIGIN_BLOCK):
+            block = np.arange(b, min(b+ORIGIN_BLOCK, norigin))
+            dist = engine.shortest_path_trees(engine.origins[block])[0]
+            for i, o in enumerate(block):
+                odslice = slice(engine.odptr[o], engine.odptr[o+1])
+                mincost += np.dot(engine.odflow[odslice], dist[i, engine.oddest[odslice]])
+        cost = np.dot(c, x)
+        gap = (cost - mincost) / cost
+        if verbose:
+            print 'Iter #{}: Tf={}, gap={}, e={}'.format(k+1, kernel.compute_obj(x), gap, e)
+        if trace is not None: trace.append(gap)
+        if gap < e:
+            break
+        # Step 2 (Bush update and equilibration) origin by origin
+        dd = kernel.compute_ddelay(x)
+        for bush in bushes:
+            bush.update(x, c)
+            bush.equilibrate(kernel, x, c, dd)
+
+    linkflows = matrix(x)
+
+    if update:
+        logging.info('Update link flows, delays in Graph.'); graph.update_linkflows_linkdelays(linkflows)
+        logging.info('Update path delays in Graph.'); graph.update_pathdelays()
+
+    if full: return linkflows, matrix(kernel.compute_delay(x)).T*linkflows
+    return linkflows
+
+
+def update_paths(graph, paths):
+    """Add the paths of a PathSet to graph and update path flows and delays"""
+    if isinstance(graph, CompactGraph): return
+    linkids = dict([(indx, id) for id, indx in graph.indlinks.iteritems()])
+    nodes = {}
+    for k in xrange(paths.numpaths):
+        link_ids = [linkids[indx] for indx in paths.links(k)]
+        node_ids = tuple([link_ids[0][0]] + [id[1] for id in link_ids])
+        if node_ids not in graph.paths: graph.add_path(link_ids, list(node_ids))
+        nodes[k] = node_ids
+    pathflows = np.zeros(graph.numpaths)
+    for k, node_ids in nodes.iteritems():
+        pathflows[graph.indpaths[node_ids]] += paths.flow[k]
+    graph.update_pathflows(pathflows)
+    graph.update_pathdelays()
+
+
 def solver_rue(graph=None, update=False, full=False, data=None, SO=False, e=1e-4, niter=1e4, verbose=False):
     """robust user equilibrium"""
     # initial link flow
@@ -450,19 +691,14 @@ def solver_rue(graph=None, update=False, full=False, data=None, SO=False, e=1e-4
     # e>0, k=0 (using Dijkstra's shortest path algorithm in networkx
     LBD = 0.
     f = solver_kernal(graph)
+    kernel = create_cost_kernel(graph)
+    def linkflows_func(f):
+        return np.array(f).reshape((-1, nlink)).sum(axis=0)
     def Tf_func(f):
-        linkflows = matrix(0.0, (nlink,1))
-        for k in xrange(npair): linkflows += f[k*nlink:(k+1)*nlink]
-        return sum([graph.links[link_key].delayfunc.compute_obj(linkflows[link_indx]) for link_key, link_indx
-                in graph.indlinks.iteritems()])
+        return kernel.compute_obj(linkflows_func(f))
     def dTf_func(f):
-        linkflows = matrix(0.0, (nlink,1))
-        for k in xrange(npair): linkflows += f[k*nlink:(k+1)*nlink]
-        dTf = nlink*[0.0]
-        for link_key, link_indx in graph.indlinks.iteritems():
-            dTfi = graph.links[link_key].delayfunc.compute_delay(linkflows[link_indx])
-            dTf[link_indx] = dTfi
-        dTf = matrix(npair*dTf)
+        dTf = kernel.compute_delay(linkflows_func(f))
+        dTf = matrix(np.tile(dTf, npair))
         return dTf
     for k in xrange(int(niter)):
         # Step 1 (Search direction generation) LP problem
@@ -483,13 +719,7 @@ def solver_rue(graph=None, update=False, full=False, data=None, SO=False, e=1e-4
         if LBD!=0 and (Tf - LBD) / LBD < e:
             break
         # Step 3 (Line search)
-        #def T(step):
-            #obj, jac = Tf_func(f+step*p), dTf_func(f+step*p).T*p
-            #return [obj, np.array(jac[0])]
-        #step = op.minimize(T, x0=0.5, jac=True, bounds=[(0.,1.)]).x
-        def T(step):
-            return  Tf_func(f+step*p)
-        step = op.minimize(T, 0.5, method='L-BFGS-B', bounds=[(0., 1.)]).x[0]
+        step = kernel.line_search(linkflows_func(f), linkflows_func(p))
         #step = 1./(k+2)
         # Step 4 (Update)
         f += step*p
@@ -558,7 +788,7 @@ def solver_sue(graph=None, update=False, full=False, data=None, SO=False, verbos
         # Inner Loop
         for i in xrange(int(ninner)):
             # Step 1: sample one realization for each link
-            graph_tmp = copy.deepcopy(graph)
+            graph_tmp = graph.overlay()
             update_func(graph_tmp, capacity, bridge_indx)
             #yi = solver_kernal(graph_tmp, f, Aeq, beq, nlink)
             yi = solver_kernal(graph_tmp, flow=f, algorithm='Dijkstra', output='dense')
@@ -594,63 +824,33 @@ def solver_sue(graph=None, update=False, full=False, data=None, SO=False, verbos
     return linkflows
 
 
-def solver_kernal(graph=None, flow=None, algorithm='Dijkstra', output='dense'):
-    nnode = len(graph.nodes.keys())
-    npair = len(graph.ODs.keys())
-    nlink = len(graph.links.keys())
-    nrow = nnode*npair
-    ncol = nlink*npair
+def solver_kernal(graph=None, flow=None, algorithm='Dijkstra', output='dense', linkcosts=None):
+    """All-or-nothing assignment of the OD flows of graph
 
-    G = nx.DiGraph()
-    G.add_nodes_from(graph.nodes.keys())
-    G.add_edges_from([(key[0],key[1]) for key in graph.links.keys()])
-    for u,v in G.edges():
-        if flow is None:
-            G[u][v]['cost'] = 0.
-            linklabel = 1
-            while True:
-                try:
-                    link = graph.links[(u,v,linklabel)]
-                    G[u][v]['cost'] += link.delayfunc.compute_delay(link.flow)
-                    linklabel +=1
-                except KeyError:
-                    break
-        else:
-            G[u][v]['cost'] = 0.
-            linklabel = 1
-            while True:
-                try:
-                    indx = graph.indlinks[(u,v,linklabel)]
-                    link = graph.links[(u,v,linklabel)]
-                    G[u][v]['cost'] += link.delayfunc.compute_delay(flow[indx])
-                    linklabel +=1
-                except KeyError:
-                    break
-
-    f = matrix(0.0,(ncol,1))
-    iod = 0
-    for OD in graph.ODs.itervalues():
-        npath = 0
-        for nodes_on_path in nx.all_shortest_paths(G, OD.o, OD.d, weight='cost'):
-            for indx in xrange(len(nodes_on_path)-1):
-                u = nodes_on_path[indx]
-                v = nodes_on_path[indx+1]
-                indx=iod*nlink+graph.indlinks[(u,v,1)]
-                f[indx,0] += OD.flow
-            npath += 1
-        f[(iod*nlink):(iod*nlink+nlink)] = f[(iod*nlink):(iod*nlink+nlink)]/npath
-        #nodes_on_path = nx.dijkstra_path(G, OD.o, OD.d, weight='cost')
-        #for indx in xrange(len(nodes_on_path)-1):
-            #u = nodes_on_path[indx]
-            #v = nodes_on_path[indx+1]
-            #indx=iod*nlink+graph.indlinks[(u,v,1)]
-            #f[indx,0] = OD.flow
-        iod += 1
+    Parameters
+    ----------
+    graph: graph object
+    flow: link flows at which link costs are evaluated (link.flow if None, zero
+        for a CompactGraph)
+    linkcosts: link costs indexed by graph.indlinks (computed from flow if None)
 
-    linkflows = matrix(0.0, (nlink,1))
-    for k in xrange(npair): linkflows += f[k*nlink:(k+1)*nlink]
+    Return value
+    ------------
+    linkflows: all-or-nothing link flows
+    """
+    if linkcosts is None and isinstance(graph, CompactGraph):
+        # a CompactGraph stores no link flows
+        linkcosts = create_cost_kernel(graph).compute_delay(np.zeros(graph.numlinks) if flow is None else flow)
+    if linkcosts is None:
+        linkcosts = np.zeros(graph.numlinks)
+        for link_key, link_indx in graph.indlinks.iteritems():
+            link = graph.links[link_key]
+            linkflow = link.flow if flow is None else flow[link_indx]
+            linkcosts[link_indx] = link.delayfunc.compute_delay(linkflow)
+    engine = get_spengine(graph)
+    linkflows = engine.all_or_nothing(linkcosts)
 
-    return linkflows
+    return matrix(linkflows)
 
 
 def solver_kernal_path(graph, lpmtx, pflow=None, algorithm='Dijkstra', output='dense'):
@@ -793,7 +993,7 @@ if __name__ == '__main__':
         for nsmp in nsmp_array:
             for i in xrange(nsmp):
                 #update_func(graph, capacity, initial=True)
-                graph = copy.deepcopy(graph0)
+                graph = graph0.overlay()
                 update_func(graph, capacity, bridge_indx=bridge_indx)
                 res = solver_fw(graph, full=True)
                 total_delay.append(res[1][0,0])
@@ -0,0 +1,196 @@
+import zlib
+import numpy as np
+from collections import OrderedDict
+from multiprocessing import Lock, sharedctypes
+
+def profile_key(fail):
+    """Bitset of failed bridges as a Python int (bit i set if bridge i failed)
+
+    Parameters
+    ----------
+    fail: boolean array of failed bridges (i.e. logical_not of a safety profile)
+    """
+    key = 0
+    for i in np.flatnonzero(fail):
+        key |= 1 << int(i)
+    return key
+
+def hamming(key1, key2):
+    """Number of bridges whose state differs between two profile keys"""
+    return bin(key1 ^ key2).count('1')
+
+def key_bits(key, nbyte):
+    """Fixed-width packed bytes (uint8 array, little endian) of a profile key"""
+    return np.array([(key >> (8*j)) & 0xff for j in xrange(nbyte)], dtype=np.uint8)
+
+def _shared_array(dtype, shape):
+    dtype = np.dtype(dtype)
+    raw = sharedctypes.RawArray('b', int(np.prod(shape))*dtype.itemsize)
+    return np.frombuffer(raw, dtype=dtype).reshape(shape)
+
+
+class ProfileCache:
+    """Bounded cache of UE results of failure profiles (least recently used
+    entries are evicted beyond maxsize), keyed by profile_key. It can be used
+    in place of the bookkeeping dict of delay_samples"""
+    def __init__(self, maxsize=2**16):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits, self.misses, self.evictions = 0, 0, 0
+
+    def get(self, key, default=None):
+        value = self.entries.pop(key, None)
+        if value is None:
+            self.misses += 1
+            return default
+        self.entries[key] = value
+        self.hits += 1
+        return value
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None: raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.entries.pop(key, None)
+        self.entries[key] = value
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def __len__(self):
+        return len(self.entries)
+
+    def stats(self):
+        """Hits, misses, evictions and size of the cache"""
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'size': len(self)}
+
+
+class FlowCache(ProfileCache):
+    """Bounded cache of UE link flows of solved failure profiles, keyed by
+    profile_key, to warm-start the solution of new profiles"""
+    def __init__(self, maxsize=2**10):
+        ProfileCache.__init__(self, maxsize)
+
+    def nearest(self, key):
+        """(key, link flows) of the cached profile closest to key in Hamming
+        distance (most recently used first on ties), (None, None) if empty"""
+        best, bestdist = None, None
+        for cached in reversed(self.entries):
+            dist = hamming(cached, key)
+            if bestdist is None or dist < bestdist:
+                best, bestdist = cached, dist
+                if dist == 0: break
+        if best is None: return None, None
+        return best, self.entries[best]
+
+
+class SharedProfileCache:
+    """Cache of UE results of failure profiles shared by the processes of a pool
+
+    Entries are keyed by profile_key and stored as fixed-width bitsets in a
+    set-associative table in shared memory: a key hashes to one set of `ways`
+    slots. Lookups are lock-free (each slot carries a sequence number that is
+    odd while the slot is written, and a read is retried if it changed); only
+    inserts take a lock. When a set is full, the least recently used entry of
+    the set is evicted (approximately, access times are not locked). The cache
+    must be created before the pool is forked, and each process counts its
+    hits and misses in its own row of shared counters. It can be used in place
+    of the bookkeeping dict of delay_samples.
+    """
+    def __init__(self, nbridge, capacity=2**16, nvalue=2, ways=8, maxprocess=256):
+        self.nbyte = max(int(np.ceil(nbridge/8.)), 1)
+        self.ways = ways
+        self.nset = max(int(np.ceil(capacity/float(ways))), 1)
+        self.nvalue = nvalue
+        nslot = self.nset*ways
+        self.keys = _shared_array(np.uint8, (nslot, self.nbyte))
+        self.values = _shared_array(np.float64, (nslot, nvalue))
+        self.seqs = _shared_array(np.int64, (nslot,))
+        self.used = _shared_array(np.bool_, (nslot,))
+        # last access time of each slot
+        self.ticks = _shared_array(np.int64, (nslot,))
+        self.clock = _shared_array(np.int64, (1,))
+        # hits, misses, inserts, evictions per process (row 0 for the parent process)
+        self.counters = _shared_array(np.int64, (maxprocess+1, 4))
+        self.nprocess = _shared_array(np.int64, (1,))
+        self.lock = Lock()
+        self.row = 0
+
+    def register(self):
+        """Assign a row of counters to the calling (worker) process"""
+        with self.lock:
+            self.nprocess[0] += 1
+            self.row = int(self.nprocess[0]) % self.counters.shape[0]
+
+    def _encode(self, key):
+        return key_bits(key, self.nbyte)
+
+    def _touch(self, slot):
+        self.clock[0] += 1
+        self.ticks[slot] = self.clock[0]
+
+    def _slots(self, bits):
+        s = (zlib.crc32(bits.tostring()) & 0xffffffff) % self.nset
+        return np.arange(s*self.ways, (s+1)*self.ways)
+
+    def _find(self, bits):
+        """Index of the slot holding bits, -1 if absent"""
+        slots = self._slots(bits)
+        hit = np.nonzero(self.used[slots] & np.all(self.keys[slots] == bits, axis=1))[0]
+        return slots[hit[0]] if hit.size else -1
+
+    def get(self, key, default=None):
+        """Cached values of key (as a list), default if absent"""
+        bits = self._encode(key)
+        while True:
+            slot = self._find(bits)
+            if slot < 0: break
+            seq = self.seqs[slot]
+            value = list(self.values[slot])
+            if seq % 2 == 0 and seq == self.seqs[slot] and np.all(self.keys[slot] == bits):
+                self._touch(slot)
+                self.counters[self.row, 0] += 1
+                return value
+        self.counters[self.row, 1] += 1
+        return default
+
+    def __contains__(self, key):
+        return self._find(self._encode(key)) >= 0
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None: raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        bits = self._encode(key)
+        with self.lock:
+            slot = self._find(bits)
+            if slot < 0:
+                slots = self._slots(bits)
+                free = slots[np.logical_not(self.used[slots])]
+                if free.size == 0:
+                    # evict the least recently used entry of the set
+                    free = slots[np.argsort(self.ticks[slots])]
+                    self.counters[self.row, 3] += 1
+                slot = free[0]
+            self.seqs[slot] += 1
+            self.keys[slot] = bits
+            self.values[slot] = value
+            self.used[slot] = True
+            self.seqs[slot] += 1
+            self._touch(slot)
+            self.counters[self.row, 2] += 1
+
+    def __len__(self):
+        return int(np.sum(self.used))
+
+    def stats(self):
+        """Total hits, misses, inserts and evictions over all processes"""
+        hits, misses, inserts, evictions = np.sum(self.counters, axis=0)
+        return {'hits': hits, 'misses': misses, 'inserts': inserts, 'evictions': evictions, 'size': len(self)}
@@ -0,0 +1,82 @@
+import numpy as np
+
+import pyNBI.traffic as pytraffic
+from pyNBI.cache import ProfileCache, FlowCache
+from pyNBI.sampling import ConditionForecast, FailureSampler, profile_keys
+
+
+class LifecycleEngine:
+    """Monte Carlo engine of the total delay of a network over the lifecycle of
+    its bridges
+
+    The condition distributions of the bridges are propagated from one year of
+    interest to the next (ConditionForecast.distributions), and the failure
+    profiles of all years are sampled with common random numbers (the same
+    random numbers of FailureSampler.draw in every year), so that most profiles
+    of adjacent years coincide. UE results of failure profiles are kept in a
+    bookkeeping cache shared by all years, and UE of a new profile is
+    warm-started from the nearest solved profile (resolve_failure_profile).
+
+    Parameters
+    ----------
+    graph0: undamaged network (pyDUE Graph)
+    bridge_db, pmatrix, cap_drop_array, theta, delaytype: as delay_samples
+    correlation, corrcoef: correlation of bridge failures and of the failures
+        of superstructure and substructure
+    x0: UE link flows of graph0 (to warm-start UE)
+    bookkeeping: dict-like cache of [total_delay, total_distance] keyed by
+        profile_key (a ProfileCache if None)
+    solver: UE solver of solve_failure_profile (ue.solver_fw if None)
+    """
+    def __init__(self, graph0, bridge_db, pmatrix, cap_drop_array, theta, delaytype, correlation=None,
+            corrcoef=0., x0=None, bookkeeping=None, solver=None):
+        self.graph0 = graph0
+        self.bridge_db = bridge_db
+        self.forecast = ConditionForecast(pmatrix)
+        self.cap_drop_array = cap_drop_array
+        self.theta = theta
+        self.delaytype = delaytype
+        self.correlation = correlation
+        self.corrcoef = corrcoef
+        self.solver = solver
+        self.bookkeeping = ProfileCache() if bookkeeping is None else bookkeeping
+        self.solutions = FlowCache()
+        if x0 is not None: self.solutions[0] = np.array(x0).ravel()
+        self.all_capacity = np.zeros(graph0.numlinks)
+        for link, link_indx in graph0.indlinks.iteritems():
+            self.all_capacity[link_indx] = graph0.links[link].capacity
+
+    def profile_results(self, fail, key):
+        """total_delay and total_distance of the failure profile fail (with profile_key key)"""
+        cached = self.bookkeeping.get(key)
+        if cached is not None: return cached[0], cached[1]
+        fail_bridges = self.bridge_db[fail]
+        total_delay, total_distance, linkflows = pytraffic.resolve_failure_profile(self.graph0,
+                self.all_capacity, fail_bridges, self.cap_drop_array[fail], self.theta, self.delaytype,
+                key, self.solutions, solver=self.solver)
+        self.bookkeeping[key] = [total_delay, total_distance]
+        return total_delay, total_distance
+
+    def run(self, nsmp, time_array, rng=None):
+        """Total delay samples over the lifecycle
+
+        Parameters
+        ----------
+        nsmp: number of samples per year
+        time_array: years of interest (even numbers)
+        rng: numpy RandomState (the global numpy random state if None)
+
+        Return value
+        ------------
+        total_delay_history: array (len(time_array), nsmp), total_distance_history likewise
+        """
+        dists = self.forecast.distributions(time_array, self.bridge_db)
+        sampler = FailureSampler(dists[0], self.correlation, self.corrcoef)
+        randoms = sampler.draw(nsmp, rng)
+        total_delay_history = np.zeros((len(dists), int(nsmp)))
+        total_distance_history = np.zeros((len(dists), int(nsmp)))
+        for i, cs_dist in enumerate(dists):
+            fails, pfs = sampler.for_distribution(cs_dist).profiles(*randoms)
+            for j, (fail, key) in enumerate(zip(fails, profile_keys(fails))):
+                total_delay_history[i,j], total_distance_history[i,j] = self.profile_results(fail, key)
+        return total_delay_history, total_distance_history
@@ -0,0 +1,293 @@
+import numpy as np
+import scipy.stats as stats
+from multiprocessing import Pool, sharedctypes
+
+from pyDUE.compact_graph import CompactGraph, compact_graph
+from pyDUE.shortest_path import get_spengine
+import pyNBI.traffic as pytraffic
+from pyNBI.cache import ProfileCache, FlowCache, SharedProfileCache
+from pyNBI.risk import social_cost
+from pyNBI.sampling import FailureSampler, weighted_estimate, paired_estimate
+
+# state of the worker processes, set once by _init_worker
+_worker = {}
+
+def share_arrays(arrays):
+    """Copy arrays into shared memory (multiprocessing.sharedctypes.RawArray),
+    return a dict of (raw array, dtype, shape) to be attached by the workers"""
+    shared = {}
+    for key, value in arrays.iteritems():
+        value = np.ascontiguousarray(value)
+        raw = sharedctypes.RawArray('b', max(value.nbytes, 1))
+        np.frombuffer(raw, dtype=value.dtype, count=value.size)[:] = value.ravel()
+        shared[key] = (raw, value.dtype.str, value.shape)
+    return shared
+
+def attach_arrays(shared):
+    """NumPy views (no copy) of arrays created by share_arrays"""
+    arrays = {}
+    for key, (raw, dtype, shape) in shared.iteritems():
+        arrays[key] = np.frombuffer(raw, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+    return arrays
+
+def _init_worker(shared, context, cache=None):
+    """Pool initializer: attach the shared network state and build the graph of the worker once"""
+    arrays = attach_arrays(shared)
+    _worker.clear()
+    _worker.update(context)
+    _worker['graph'] = CompactGraph(arrays, context['delaytype']).to_graph()
+    # shortest-path engine built once per worker and shared by all scenario overlays
+    get_spengine(_worker['graph'])
+    _worker['all_capacity'] = arrays['all_capacity']
+    _worker['correlation'] = arrays['correlation'] if 'correlation' in arrays else None
+    _worker['x0'] = arrays['x0'] if 'x0' in arrays else None
+    _worker['solutions'] = FlowCache()
+    _worker['sampler'] = FailureSampler(context['cs_dist'], _worker['correlation'], context['corrcoef'])
+    if cache is None:
+        _worker['bookkeeping'] = ProfileCache()
+    else:
+        cache.register()
+        _worker['bookkeeping'] = cache
+
+def _risk_block(unit):
+    """Run one work unit (bridge_indx, block, nsmp, seed), return (bridge_indx,
+    block, risk samples, total delays, total distances)"""
+    bridge_indx, block, nsmp, seed = unit
+    np.random.seed(seed)
+    w = _worker
+    indx, smp, delays, distances = pytraffic.delay_samples(nsmp, w['graph'], w['cost0'], w['all_capacity'], w['t'],
+            bridge_indx, w['bridge_db'], w['cs_dist'], w['cap_drop_array'], w['theta'], w['delaytype'],
+            correlation=w['correlation'], nataf=w['nataf'], corrcoef=w['corrcoef'], x0=w['x0'],
+            bookkeeping=w['bookkeeping'], solutions=w['solutions'], solver=w['solver'],
+            sampler=w['sampler'], proposal=w['proposal'], method=w['method'], control=w['control'], full=True)
+    return bridge_indx, block, smp, delays, distances
+
+
+class RiskEngine:
+    """Parallel Monte Carlo engine for risk-based ranking of bridges
+
+    The network (graph0, all_capacity, correlation and x0) is copied once into
+    shared memory and attached read-only by the workers of a process pool, each
+    of which builds its own graph once. Work units are blocks of samples of one
+    bridge, so that the load stays balanced until the last block, and the risk
+    samples of each block are returned as soon as it is done. UE results of
+    failure profiles are shared by all workers through a SharedProfileCache
+    of cache_size entries (a ProfileCache per worker if cache_size is 0), and
+    each worker warm-starts UE from the nearest profile it has solved. solver
+    is the UE solver of the failure profiles (ue.solver_fw if None). If
+    proposal is given (e.g. pyNBI.sampling.design_point_proposal), the field of
+    the bridge failures is importance sampled and the risk samples are weighted
+    by their likelihood ratios. method ('mc', 'antithetic' or 'lhs') is the
+    sampling of the failure profiles of each block (antithetic pairs stay in
+    consecutive rows of run if block_size is even; 'mc' only with proposal),
+    and control a pyNBI.sampling.DetourControlVariate correcting the risk
+    samples.
+    """
+    def __init__(self, graph0, cost0, all_capacity, t, bridge_db, cs_dist, cap_drop_array, theta,
+            delaytype, correlation=None, nataf=None, corrcoef=0., x0=None, cache_size=2**16, solver=None,
+            proposal=None, method='mc', control=None):
+        if proposal is not None and method != 'mc':
+            raise ValueError('importance sampling (proposal) only supports method mc, not {}'.format(method))
+        self.arrays = compact_graph(graph0).arrays()
+        self.arrays['all_capacity'] = np.asarray(all_capacity, dtype=float)
+        if correlation is not None: self.arrays['correlation'] = np.asarray(correlation, dtype=float)
+        if x0 is not None: self.arrays['x0'] = np.asarray(x0, dtype=float).ravel()
+        self.context = {'cost0': cost0, 't': t, 'bridge_db': bridge_db, 'cs_dist': cs_dist,
+            'cap_drop_array': cap_drop_array, 'theta': theta, 'delaytype': delaytype,
+            'nataf': nataf, 'corrcoef': corrcoef, 'solver': solver, 'proposal': proposal,
+            'method': method, 'control': control}
+        self.cache = None
+        if cache_size > 0: self.cache = SharedProfileCache(bridge_db.shape[0], cache_size)
+
+    def work_units(self, bridge_indices, nsmp, block_size, seed=None):
+        """Work units (bridge_indx, block, nsmp of the block, seed), block by block over all bridges"""
+        rng = np.random.RandomState(seed)
+        nblock = int(np.ceil(nsmp/float(block_size)))
+        seeds = rng.randint(2**31-1, size=(nblock, len(bridge_indices)))
+        units = []
+        for block in xrange(nblock):
+            nblock_smp = min(block_size, nsmp-block*block_size)
+            for i, bridge_indx in enumerate(bridge_indices):
+                units.append((int(bridge_indx), block, nblock_smp, seeds[block, i]))
+        return units
+
+    def iter_rounds(self, next_round, nprocess=None):
+        """Generator of (bridge_indx, block, risk samples, total delays, total
+        distances) of rounds of work units in order of completion, with the same pool for all rounds:
+        next_round() returns the units of the next round (none to stop) and
+        is called once all results of the previous round have been yielded"""
+        shared = share_arrays(self.arrays)
+        if nprocess == 1:
+            _init_worker(shared, self.context, self.cache)
+            units = next_round()
+            while units:
+                for unit in units:
+                    yield _risk_block(unit)
+                units = next_round()
+            return
+        pool = Pool(processes=nprocess, initializer=_init_worker,
+                initargs=(shared, self.context, self.cache))
+        try:
+            units = next_round()
+            while units:
+                results = pool.imap_unordered(_risk_block, units)
+                while True:
+                    try:
+                        # a timeout keeps KeyboardInterrupt deliverable while waiting
+                        yield results.next(0xFFFF)
+                    except StopIteration:
+                        break
+                units = next_round()
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+    def iter_blocks(self, bridge_indices, nsmp, block_size=100, nprocess=None, seed=None, units=None):
+        """Generator of (bridge_indx, block, risk samples, total delays, total
+        distances) in order of completion, of units (all work units if None)"""
+        if units is None: units = self.work_units(bridge_indices, nsmp, block_size, seed)
+        rounds = [units]
+        return self.iter_rounds(lambda: rounds.pop() if rounds else [], nprocess)
+
+    def run(self, bridge_indices, nsmp, block_size=100, nprocess=None, seed=None, store=None):
+        """Risk samples of all bridges as an array (nsmp, len(bridge_indices))
+
+        If store (a pyNBI.store.RunStore) is given, the samples of each block
+        are appended to it as soon as they are done, and a run interrupted
+        with the same store is resumed: its seed and work units are those of
+        the store, and blocks already in the store are not run again.
+        """
+        column = dict([(int(b), i) for i, b in enumerate(bridge_indices)])
+        bridge_risk_data = np.zeros((nsmp, len(bridge_indices)))
+        if store is None:
+            for bridge_indx, block, smp, delays, distances in self.iter_blocks(bridge_indices, nsmp, block_size,
+                    nprocess, seed):
+                bridge_risk_data[block*block_size:block*block_size+smp.size, column[bridge_indx]] = smp
+            return bridge_risk_data
+        seed = store.resume({'bridge_indices': [int(b) for b in bridge_indices], 'nsmp': int(nsmp), 'block_size': int(block_size),
+            'seed': seed})['seed']
+        units = self.work_units(bridge_indices, nsmp, block_size, seed)
+        completed = store.completed()
+        units = [unit for unit in units if completed.get((unit[0], unit[1]), 0) < unit[2]]
+        seeds = dict([((unit[0], unit[1]), unit[3]) for unit in units])
+        for bridge_indx, block, smp, delays, distances in self.iter_blocks(bridge_indices, nsmp, block_size,
+                nprocess, units=units):
+            store.append(bridge_indx, block, seeds[(bridge_indx, block)], block*block_size, smp, delays, distances)
+        records = store.records()
+        records = records[np.in1d(records['bridge'], sorted(column)) & (records['sample'] < nsmp)]
+        bridge_risk_data[records['sample'], [column[b] for b in records['bridge']]] = records['risk']
+        return bridge_risk_data
+
+    def rank(self, bridge_indices, k=None, round_size=100, nmin=None, max_nsmp=10000, confidence=0.95,
+            cost_tol=1e-4, nprocess=None, seed=None, verbose=False, full=False):
+        """Adaptive ranking of bridges by risk (racing)
+
+        Samples are run in rounds of round_size samples per bridge (nmin in
+        the first round, 10*round_size if None, so that the first estimates of
+        the skewed risk samples are not settled on a few draws). After each
+        round, the confidence interval of the risk of each bridge is updated,
+        and bridges whose rank is settled (settled_bridges) or with max_nsmp
+        samples are stopped, so that the following rounds are spent on the
+        contested bridges only. A bridge is never settled before a rare event
+        is observed in its samples, i.e. before they show two network costs
+        (failure of the bridge alone and of other bridges as well) more than
+        cost_tol*cost0 apart, as the risk samples of a single profile vary
+        with the failure probability of the bridge only. As the intervals
+        are looked at after each round and across all bridges, their level is
+        Bonferroni corrected: 1-(1-confidence)/(n*max_rounds) for n bridges
+        and at most max_rounds rounds.
+
+        Parameters
+        ----------
+        bridge_indices: bridges to rank
+        k: if not None, only the membership of the top k bridges is settled
+            (the full ranking if None)
+        confidence: overall confidence level of the settled ranks
+        cost_tol: network cost changes below cost_tol*cost0 (round-off of UE)
+            are not rare events
+        full: if True, the risk samples of each bridge are also returned
+
+        Return value
+        ------------
+        order: bridge indices by decreasing risk
+        means, variances, nsmps, settled: risk, variance of the risk estimate,
+            number of samples and settled flags of bridge_indices
+        (if full: also a list of the risk samples of bridge_indices)
+        """
+        bridge_indices = [int(b) for b in bridge_indices]
+        n = len(bridge_indices)
+        column = dict([(b, i) for i, b in enumerate(bridge_indices)])
+        if nmin is None: nmin = 10*round_size
+        nmin = min(nmin, max_nsmp)
+        max_rounds = 1 + int(np.ceil(float(max_nsmp-nmin)/round_size))
+        alpha = (1.-confidence)/(n*max_rounds)
+        z = stats.norm.ppf(1.-0.5*alpha)
+        rng = np.random.RandomState(seed)
+        samples = [{} for b in bridge_indices]
+        nsmps = np.zeros(n, dtype=int)
+        means, variances = np.zeros(n), np.inf*np.ones(n)
+        settled = np.zeros(n, dtype=bool)
+        # network cost of the first sample of each bridge and whether another one was observed
+        reference, observed = np.nan*np.ones(n), np.zeros(n, dtype=bool)
+        cost0, t = self.context['cost0'], self.context['t']
+        state = {'round': 0}
+
+        def next_round():
+            if state['round'] > 0:
+                for i in xrange(n):
+                    if samples[i]: means[i], variances[i] = self.estimate(samples[i])
+                settled[:] = settled_bridges(means, np.sqrt(variances), z, k) & observed
+                if verbose:
+                    print 'Round #{}: {} of {} bridges settled, {} samples'.format(
+                            state['round'], np.sum(settled), n, np.sum(nsmps))
+            active = np.flatnonzero(np.logical_not(settled) & (nsmps < max_nsmp))
+            nround = nmin if state['round'] == 0 else round_size
+            units = []
+            for i in active:
+                nblock_smp = int(min(nround, max_nsmp-nsmps[i]))
+                units.append((bridge_indices[i], state['round'], nblock_smp, rng.randint(2**31-1)))
+                nsmps[i] += nblock_smp
+            state['round'] += 1
+            return units
+
+        for bridge_indx, block, smp, delays, distances in self.iter_rounds(next_round, nprocess):
+            i = column[bridge_indx]
+            samples[i][block] = smp
+            if smp.size == 0 or observed[i]: continue
+            costs = social_cost(delays, distances, t)
+            if np.isnan(reference[i]): reference[i] = costs[0]
+            observed[i] = np.any(np.abs(costs-reference[i]) > cost_tol*abs(cost0))
+        order = [bridge_indices[i] for i in np.argsort(-means, kind='mergesort')]
+        if full:
+            risks = [np.concatenate([blocks[block] for block in sorted(blocks)]) for blocks in samples]
+            return order, means, variances, nsmps, settled, risks
+        return order, means, variances, nsmps, settled
+
+    def estimate(self, blocks):
+        """Risk estimate and variance of the mean from the risk samples of the
+        blocks of a bridge (dict of arrays keyed by block)"""
+        smp = np.concatenate([blocks[block] for block in sorted(blocks)])
+        if smp.size < 2: return smp.mean(), np.inf
+        if self.context['proposal'] is not None: return weighted_estimate(smp)
+        if self.context['method'] == 'antithetic': return paired_estimate(smp)
+        return weighted_estimate(smp)
+
+
+def settled_bridges(means, ses, z, k=None):
+    """Bridges whose rank is settled given their risk estimates means and
+    standard errors ses: confidence intervals means +- z*ses disjoint from
+    those of all other bridges or, if k is not None, bridges that are in (out
+    of) the top k with confidence, i.e. whose lower (upper) bound is above
+    (below) the upper (lower) bounds of n-k (k) other bridges"""
+    lower, upper = means - z*ses, means + z*ses
+    above = lower[None,:] > upper[:,None]
+    below = upper[None,:] < lower[:,None]
+    if k is None:
+        disjoint = above | below
+        np.fill_diagonal(disjoint, True)
+        return np.all(disjoint, axis=1)
+    n = means.size
+    return (np.sum(above, axis=1) >= k) | (np.sum(below, axis=1) >= n-k)
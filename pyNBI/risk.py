@@ -55,3 +55,18 @@ def social_cost(total_delay, total_distance, t):
     total_cost = cost_time+cost_run
 
     return total_cost
+
+
+def detour_cost(bridge_db, t, adt, freespeed=30.):
+    """compute indirect costs of the failures of bridges (array), with the
+    average daily traffic adt of each bridge taking its detour at freespeed
+    (m/s), according to Saydam and Frangopol (2011)"""
+    detour = np.asarray(bridge_db[:,-2], dtype=float)
+    # social_cost is linear in total delay and distance
+    return np.asarray(adt, dtype=float)*social_cost(detour*1e3/freespeed, detour*1e3, t)
+
+
+def failure_costs(bridge_db, t, adt):
+    """direct (rebuild) plus indirect (detour) costs of the failure of each bridge"""
+    direct = np.array([bridge_cost(bridge_db[i:i+1], t) for i in xrange(bridge_db.shape[0])])
+    return direct + detour_cost(bridge_db, t, adt)
@@ -0,0 +1,571 @@
+import copy
+import itertools
+import numpy as np
+import scipy.stats as stats
+from scipy.special import owens_t, comb
+from scipy.stats import mvn
+
+from pyNBI.cache import profile_key
+
+def correlation_factor(correlation):
+    """Factor L of a correlation matrix with L*L' = correlation (Cholesky, or
+    from the eigendecomposition if correlation is singular)"""
+    try:
+        return np.linalg.cholesky(correlation)
+    except np.linalg.LinAlgError:
+        w, v = np.linalg.eigh(correlation)
+        return v*np.sqrt(np.maximum(w, 0.))
+
+def cs2reliable(cs):
+    rho = (4.84-1)/(8.-2.)*(cs-2) + 1.
+    beta = (rho-1.)/np.sqrt(rho**2*0.15**2+(2.5*0.15)**2)
+    return beta
+
+def antithetic_pairs(x, y):
+    """Rows of x and y interleaved (x[0], y[0], x[1], y[1], ...)"""
+    pairs = np.empty((2*x.shape[0],) + x.shape[1:], dtype=x.dtype)
+    pairs[0::2], pairs[1::2] = x, y
+    return pairs
+
+def latin_hypercube(nsmp, ndim, rng=None):
+    """Latin hypercube sample (nsmp, ndim) of the unit hypercube: each column
+    has one sample in each of the nsmp strata [k/nsmp, (k+1)/nsmp)"""
+    if rng is None: rng = np.random
+    strata = np.argsort(rng.rand(nsmp, ndim), axis=0)
+    return (strata + rng.rand(nsmp, ndim))/nsmp
+
+def joint_pf(pfe, pf, rho):
+    """Probability that two bridges with failure probabilities pfe and pf and
+    correlation rho of their failures both fail, within its Frechet bounds
+    [max(0, pfe+pf-1), min(pfe, pf)]"""
+    return np.clip(rho*np.sqrt(pfe*(1-pfe))*np.sqrt(pf*(1-pf))+pf*pfe, np.maximum(pfe+pf-1., 0.),
+            np.minimum(pfe, pf))
+
+def conditional_pf(pfe, pf, rho):
+    """Failure probability of a bridge (pf) given the failure of a bridge with
+    failure probability pfe, with correlation rho of their failures"""
+    return joint_pf(pfe, pf, rho)/pfe
+
+def bivariate_normal_cdf(h, k, rho):
+    """P(X <= h, Y <= k) of standard normal X and Y with correlation rho
+    (elementwise, by Owen's T function)"""
+    h, k, rho = np.broadcast_arrays(*[np.asarray(x, dtype=float) for x in (h, k, rho)])
+    h, k, rho = np.clip(h, -38., 38.), np.clip(k, -38., 38.), np.clip(rho, -1., 1.)
+    # Owen's T of a zero argument needs an infinite second argument
+    h, k = np.where(h == 0., 1e-10, h), np.where(k == 0., 1e-10, k)
+    s = np.sqrt(np.maximum(1.-rho**2, 1e-300))
+    ph, pk = stats.norm.cdf(h), stats.norm.cdf(k)
+    p = 0.5*(ph+pk) - owens_t(h, (k-rho*h)/(h*s)) - owens_t(k, (h-rho*k)/(k*s)) - np.where(h*k > 0., 0., 0.5)
+    p = np.where(rho >= 1.-1e-12, np.minimum(ph, pk), p)
+    p = np.where(rho <= -1.+1e-12, ph+pk-1., p)
+    return np.clip(p, 0., np.minimum(ph, pk))
+
+def profile_keys(fail):
+    """profile_key of each row of a boolean failure matrix (nsmp, nbridge)"""
+    return [profile_key(row) for row in fail]
+
+
+class DiscreteCS:
+    """Distribution of the condition state of a bridge component (a
+    lightweight, picklable replacement of scipy.stats.rv_discrete with its
+    xk, pk and rvs)"""
+    def __init__(self, xk, pk):
+        self.xk = xk
+        self.pk = pk
+
+    def rvs(self, size=1):
+        u = np.random.rand(size)
+        indx = np.minimum(np.searchsorted(np.cumsum(self.pk), u, side='right'), self.xk.size-1)
+        return self.xk[indx]
+
+
+class ConditionDistribution:
+    """Distributions of the condition states of the deck, superstructure and
+    substructure (components 0, 1, 2) of bridges, stored as state
+    probabilities pk (nbridge, 3, ncs) over the states cs
+
+    It can be used in place of the list of (name, deck_dist, super_dist,
+    sub_dist) of rv_discrete returned by condition_distribution before: items
+    are tuples of a name and three DiscreteCS.
+    """
+    def __init__(self, names, cs, pk):
+        self.names = np.asarray(names, dtype=object)
+        self.cs = np.asarray(cs, dtype=float)
+        self.pk = np.asarray(pk, dtype=float)
+        self.cdf = np.minimum(np.maximum.accumulate(np.cumsum(self.pk, axis=2), axis=2), 1.)
+
+    def __len__(self):
+        return self.pk.shape[0]
+
+    def __getitem__(self, indx):
+        return (self.names[indx],) + tuple([DiscreteCS(self.cs, self.pk[indx, k]) for k in xrange(3)])
+
+    def __iter__(self):
+        for indx in xrange(len(self)):
+            yield self[indx]
+
+    def inverse(self, u, component):
+        """Indices (into cs) of the condition states of component of all
+        bridges with uniform samples u (nsmp, nbridge), by inverse transform"""
+        nbridge, ncs = self.pk.shape[0], self.pk.shape[2]
+        # rows of the cumulative probabilities are offset by the bridge index,
+        # so that one searchsorted inverts the distributions of all bridges
+        offset = np.arange(nbridge)
+        cdf = (self.cdf[:, component, :] + offset[:,None]).ravel()
+        cdf[ncs-1::ncs] = offset+1.
+        indx = np.searchsorted(cdf, u+offset, side='right') - offset*ncs
+        return np.minimum(indx, ncs-1)
+
+    def sample(self, nsmp, rng=None):
+        """Condition states (nsmp, nbridge, 3) of nsmp samples"""
+        if rng is None: rng = np.random
+        u = rng.rand(3, int(nsmp), len(self))
+        return np.dstack([self.cs[self.inverse(u[k], k)] for k in xrange(3)])
+
+
+def as_condition_distribution(cs_dist):
+    """ConditionDistribution of cs_dist (returned as is), or of a list of
+    (name, deck_dist, super_dist, sub_dist) with a common support"""
+    if isinstance(cs_dist, ConditionDistribution): return cs_dist
+    names = [dist[0] for dist in cs_dist]
+    cs = np.asarray(cs_dist[0][1].xk, dtype=float)
+    pk = np.zeros((len(cs_dist), 3, cs.size))
+    for indx, dist in enumerate(cs_dist):
+        for k in xrange(3):
+            pk[indx, k, np.searchsorted(cs, dist[k+1].xk)] = dist[k+1].pk
+    return ConditionDistribution(names, cs, pk)
+
+
+class ConditionForecast:
+    """Markov chain forecast of the condition states of bridge components
+
+    Transition matrices over two-year steps (pmatrix['deck'], pmatrix['super']
+    and pmatrix['sub']) are raised to the power of the number of steps once
+    per (component, year) and cached.
+    """
+    COMPONENTS = ('deck', 'super', 'sub')
+
+    def __init__(self, pmatrix, cs=None):
+        if isinstance(pmatrix, np.ndarray): pmatrix = pmatrix.item()
+        self.pmatrix = pmatrix
+        self.cs = np.arange(8,0,-1) if cs is None else np.asarray(cs)
+        self.powers = {}
+
+    def transition(self, component, year):
+        """Transition matrix of component over year (an even number of years)"""
+        key = (component, int(year))
+        if key not in self.powers:
+            self.powers[key] = np.linalg.matrix_power(np.asarray(self.pmatrix[component], dtype=float),
+                    int(year)/2)
+        return self.powers[key]
+
+    def distribution(self, year, bridge_db):
+        """ConditionDistribution of the bridges of bridge_db after year, from
+        their initial deck, super and sub condition states (columns 5, 6, 7)"""
+        cs0 = np.asarray(bridge_db[:, 5:8], dtype=float)
+        pk = np.zeros((cs0.shape[0], 3, self.cs.size))
+        for k, component in enumerate(self.COMPONENTS):
+            initial = (cs0[:,k:k+1] == self.cs).astype(float)
+            pk[:,k,:] = np.dot(initial, self.transition(component, year))
+        return ConditionDistribution(bridge_db[:, 0], self.cs, pk)
+
+    def distributions(self, years, bridge_db):
+        """ConditionDistributions of the bridges of bridge_db after each of
+        years (even numbers), propagated from one year to the next in two-year
+        steps (one product per component and step)"""
+        years = [int(year) for year in years]
+        pk = self.distribution(0, bridge_db).pk
+        step = [np.asarray(self.pmatrix[component], dtype=float) for component in self.COMPONENTS]
+        dists, current = {}, 0
+        for year in sorted(set(years)):
+            for i in xrange((year-current)/2):
+                pk = np.dstack([np.dot(pk[:,k,:], step[k]) for k in xrange(3)]).transpose((0,2,1))
+            current = year
+            dists[year] = ConditionDistribution(bridge_db[:, 0], self.cs, pk)
+        return [dists[year] for year in years]
+
+class FailureSampler:
+    """Batched sampler of bridge failures, equivalent to nsmp calls of
+    pyNBI.traffic.generate_bridge_safety
+
+    The condition states of the superstructure and substructure of each bridge
+    are drawn by inverse transform of the distributions of cs_dist and mapped to
+    failure probabilities through a lookup table, and the correlated field of
+    each sample is drawn with the factor of correlation computed once. The deck
+    is not sampled (it does not enter the failure probability of a bridge).
+
+    Parameters
+    ----------
+    cs_dist: ConditionDistribution of the bridges (or a list of rv_discrete as
+        accepted by as_condition_distribution)
+    correlation: correlation matrix of the bridge failures (identity if None)
+    corrcoef: correlation of the failures of superstructure and substructure
+    """
+    def __init__(self, cs_dist, correlation=None, corrcoef=0.):
+        self.nbridge = len(cs_dist)
+        if correlation is None: correlation = np.eye(self.nbridge)
+        self.correlation = np.asarray(correlation, dtype=float)
+        self.factor = correlation_factor(self.correlation)
+        self.corrcoef = corrcoef
+        self.cs_dist = as_condition_distribution(cs_dist)
+        # failure probabilities of the condition states
+        self.pf = stats.norm.cdf(-cs2reliable(self.cs_dist.cs))
+
+    def bridge_pfs(self, u_super, u_sub):
+        """Failure probabilities (nsmp, nbridge) of bridges from the uniform
+        samples of the condition states of their superstructure and substructure"""
+        super_pf = self.pf[self.cs_dist.inverse(u_super, 1)]
+        sub_pf = self.pf[self.cs_dist.inverse(u_sub, 2)]
+        return super_pf + sub_pf - (self.corrcoef*np.sqrt(super_pf*(1-super_pf))*
+                np.sqrt(sub_pf*(1-sub_pf))+super_pf*sub_pf)
+
+    def state_tables(self):
+        """Failure probabilities of bridges in each of the (super, sub)
+        condition states (ncs**2,) and the probabilities of these states for
+        each bridge (nbridge, ncs**2)"""
+        pk, pf, rho = self.cs_dist.pk, self.pf, self.corrcoef
+        ncs = pf.size
+        super_pf, sub_pf = np.repeat(pf, ncs), np.tile(pf, ncs)
+        state_pfs = super_pf + sub_pf - (rho*np.sqrt(super_pf*(1-super_pf))*
+                np.sqrt(sub_pf*(1-sub_pf))+super_pf*sub_pf)
+        state_pk = (pk[:,1,:,None]*pk[:,2,None,:]).reshape((pk.shape[0], -1))
+        return state_pfs, state_pk
+
+    def conditional_pfs(self, pfs, bridge_indx):
+        """Failure probabilities of the bridges given the failure of bridge_indx
+        (that of bridge_indx is unchanged)"""
+        pfe = pfs[:,bridge_indx:bridge_indx+1]
+        pf1 = conditional_pf(pfe, pfs, self.correlation[bridge_indx])
+        pf1[:,bridge_indx] = pfe[:,0]
+        return pf1
+
+    def field(self, z):
+        """Correlated uniform field from independent standard normal samples z (nsmp, nbridge)"""
+        return stats.norm.cdf(np.dot(z, self.factor.T))
+
+    def for_distribution(self, cs_dist):
+        """Sampler of the same bridges with other condition distributions
+        (e.g. of another year), sharing the factor of the correlation matrix"""
+        sampler = copy.copy(self)
+        sampler.cs_dist = as_condition_distribution(cs_dist)
+        return sampler
+
+    def draw(self, nsmp, rng=None, method='mc'):
+        """Random numbers of nsmp samples: uniform samples of the condition
+        states of superstructure and substructure and standard normal samples
+        of the field, each (nsmp, nbridge)
+
+        method: 'mc' for independent samples, 'antithetic' for pairs of samples
+            (u, 1-u) and (z, -z) in consecutive rows, 'lhs' for a Latin
+            hypercube of all random numbers (the field is correlated afterwards
+            by profiles)
+        """
+        if rng is None: rng = np.random
+        nsmp = int(nsmp)
+        if method == 'antithetic':
+            half = (nsmp+1)/2
+            u_super, u_sub, z = self.draw(half, rng)
+            return (antithetic_pairs(u_super, 1.-u_super)[:nsmp], antithetic_pairs(u_sub, 1.-u_sub)[:nsmp],
+                    antithetic_pairs(z, -z)[:nsmp])
+        if method == 'lhs':
+            u = latin_hypercube(nsmp, 3*self.nbridge, rng)
+            n = self.nbridge
+            return u[:,:n], u[:,n:2*n], stats.norm.ppf(u[:,2*n:])
+        if method != 'mc': raise ValueError('unknown sampling method {}'.format(method))
+        return rng.rand(nsmp, self.nbridge), rng.rand(nsmp, self.nbridge), rng.standard_normal((nsmp, self.nbridge))
+
+    def profiles(self, u_super, u_sub, z, bridge_indx=None):
+        """Failure profiles and failure probabilities from the random numbers of draw"""
+        pfs = self.bridge_pfs(u_super, u_sub)
+        if bridge_indx is not None:
+            pfs = self.conditional_pfs(pfs, bridge_indx)
+        fail = pfs >= self.field(z)
+        if bridge_indx is not None:
+            fail[:,bridge_indx] = True
+        return fail, pfs
+
+    def sample(self, nsmp, bridge_indx=None, rng=None):
+        """Sample nsmp failure profiles
+
+        Parameters
+        ----------
+        nsmp: number of samples
+        bridge_indx: if not None, bridge_indx is failed and the failure
+            probabilities of the other bridges are conditional on its failure
+        rng: numpy RandomState (the global numpy random state if None)
+
+        Return value
+        ------------
+        fail: boolean failure matrix (nsmp, nbridge)
+        pfs: failure probabilities (nsmp, nbridge) (as bridge_pfs of generate_bridge_safety)
+        """
+        return self.profiles(*self.draw(nsmp, rng), bridge_indx=bridge_indx)
+
+    def mean_pfs(self):
+        """Failure probabilities of the bridges averaged over their condition
+        states (superstructure and substructure are independent)"""
+        pk = self.cs_dist.pk
+        pf, sd = self.pf, np.sqrt(self.pf*(1-self.pf))
+        super_pf, sub_pf = np.dot(pk[:,1,:], pf), np.dot(pk[:,2,:], pf)
+        super_sd, sub_sd = np.dot(pk[:,1,:], sd), np.dot(pk[:,2,:], sd)
+        return super_pf + sub_pf - (self.corrcoef*super_sd*sub_sd + super_pf*sub_pf)
+
+    def importance_draw(self, nsmp, proposal, rng=None):
+        """Random numbers of draw with the field sampled from proposal (a
+        MixtureProposal) instead of the standard normal distribution, and the
+        likelihood ratios (weights) of the samples"""
+        if rng is None: rng = np.random
+        nsmp = int(nsmp)
+        u_super, u_sub = rng.rand(nsmp, self.nbridge), rng.rand(nsmp, self.nbridge)
+        z, weights = proposal.draw(nsmp, rng)
+        return (u_super, u_sub, z), weights
+
+
+class MixtureProposal:
+    """Gaussian mixture importance sampling density of the standard normal
+    samples z of the field of a FailureSampler
+
+    q(z) = sum_c alpha_c * phi(z - means_c), with phi the standard normal
+    density, so that the likelihood ratio of a sample is
+    phi(z)/q(z) = 1/sum_c alpha_c*exp(means_c.z - |means_c|^2/2).
+
+    Parameters
+    ----------
+    means: array (ncomponent, nbridge) of the means of the components
+    alpha: probabilities of the components (uniform if None)
+    """
+    def __init__(self, means, alpha=None):
+        self.means = np.atleast_2d(np.asarray(means, dtype=float))
+        ncomponent = self.means.shape[0]
+        if alpha is None: alpha = np.ones(ncomponent)/ncomponent
+        self.alpha = np.asarray(alpha, dtype=float)/np.sum(alpha)
+
+    def log_ratio(self, z):
+        """log(phi(z)/q(z)) of samples z (nsmp, nbridge)"""
+        a = np.log(self.alpha) + np.dot(z, self.means.T) - 0.5*np.sum(self.means**2, axis=1)
+        amax = np.max(a, axis=1)
+        return -(amax + np.log(np.sum(np.exp(a-amax[:,None]), axis=1)))
+
+    def draw(self, nsmp, rng=None):
+        """nsmp samples of q and their likelihood ratios"""
+        if rng is None: rng = np.random
+        component = np.searchsorted(np.cumsum(self.alpha), rng.rand(nsmp), side='right')
+        component = np.minimum(component, self.alpha.size-1)
+        z = rng.standard_normal((nsmp, self.means.shape[1])) + self.means[component]
+        return z, np.exp(self.log_ratio(z))
+
+
+def design_point_proposal(sampler, bridges=None, defensive=0.1, pf_min=None):
+    """MixtureProposal with one component per bridge centred on the design
+    point of its failure, i.e. the field sample z of minimum norm with
+    (L*z)_i = Phi^{-1}(pf_i), for L the factor of the correlation matrix and
+    pf_i the mean failure probability of bridge i (FailureSampler.mean_pfs)
+
+    Parameters
+    ----------
+    sampler: FailureSampler
+    bridges: indices of the bridges with a component (all bridges if None)
+    defensive: probability of a component of mean 0 (the crude MC density),
+        which bounds the likelihood ratios by 1/defensive
+    pf_min: bridges with a mean failure probability above pf_min are not
+        shifted (all are shifted if None)
+    """
+    pfs = sampler.mean_pfs()
+    if bridges is None: bridges = np.arange(sampler.nbridge)
+    bridges = np.asarray(bridges)
+    if pf_min is not None: bridges = bridges[pfs[bridges] < pf_min]
+    rows = sampler.factor[bridges]
+    beta = stats.norm.ppf(pfs[bridges])
+    means = rows*(beta/np.sum(rows**2, axis=1))[:,None]
+    alpha = np.ones(bridges.size)*(1.-defensive)/max(bridges.size, 1)
+    if defensive > 0.:
+        means = np.vstack((np.zeros(sampler.nbridge), means))
+        alpha = np.append(defensive, alpha)
+    return MixtureProposal(means, alpha)
+
+
+def weighted_estimate(samples):
+    """Mean of likelihood-ratio-weighted samples (as returned by delay_samples
+    with a proposal) and the variance of the mean"""
+    samples = np.asarray(samples, dtype=float)
+    return np.mean(samples, axis=0), np.var(samples, axis=0, ddof=1)/samples.shape[0]
+
+
+def paired_estimate(samples):
+    """Mean of antithetic samples (pairs in consecutive rows, as drawn with
+    method='antithetic') and the variance of the mean from the pair means"""
+    samples = np.asarray(samples, dtype=float)
+    npair = samples.shape[0]/2
+    pairs = 0.5*(samples[0:2*npair:2] + samples[1:2*npair:2])
+    return np.mean(samples, axis=0), np.var(pairs, axis=0, ddof=1)/npair
+
+
+class DetourControlVariate:
+    """Control variate of the risk samples of a bridge (delay_samples) built
+    from the analytic detour-based costs of bridge failures
+
+    The control of a sample is pf_e*sum_i c_i*fail_i, where pf_e is the failure
+    probability of the bridge of interest e (always failed) and c_i the direct
+    (rebuild) plus indirect (detour) cost of bridge i (pyNBI.risk.bridge_cost
+    and detour_cost). Its mean is known exactly,
+
+        E = c_e*E[pf_e] + sum_{i!=e} c_i*E[min(pf_e*pf_i|e, pf_e)]
+
+    with pf_i|e the failure probability of i conditional on the failure of e
+    (FailureSampler.conditional_pfs), by enumeration of the condition states of
+    the superstructures and substructures of e and i.
+
+    Parameters
+    ----------
+    sampler: FailureSampler
+    costs: direct plus indirect costs of the failures of the bridges
+    beta: coefficient of the control (estimated from the samples if None)
+    """
+    def __init__(self, sampler, costs, beta=None):
+        self.sampler = sampler
+        self.costs = np.asarray(costs, dtype=float)
+        self.beta = beta
+        self.means = {}
+        self.state_pfs, self.state_pk = sampler.state_tables()
+
+    def mean(self, bridge_indx):
+        """Exact mean of the control of bridge_indx"""
+        if bridge_indx in self.means: return self.means[bridge_indx]
+        pfe, pfi = self.state_pfs[:,None], self.state_pfs[None,:]
+        rho = self.sampler.correlation[bridge_indx]
+        means = np.zeros(self.costs.size)
+        for i in xrange(self.costs.size):
+            joint = joint_pf(pfe, pfi, rho[i])
+            means[i] = np.dot(self.state_pk[bridge_indx], np.dot(joint, self.state_pk[i]))
+        means[bridge_indx] = np.dot(self.state_pk[bridge_indx], self.state_pfs)
+        self.means[bridge_indx] = np.dot(self.costs, means)
+        return self.means[bridge_indx]
+
+    def values(self, fails, pfs, bridge_indx):
+        """Controls of the samples of delay_samples"""
+        return pfs[:,bridge_indx]*np.dot(fails, self.costs)
+
+    def adjust(self, samples, controls, mean):
+        """Samples corrected by the control: samples - beta*(controls - mean)"""
+        beta = self.beta
+        if beta is None:
+            var = np.var(controls, ddof=1)
+            beta = np.cov(samples, controls)[0,1]/var if var > 0. else 0.
+        return samples - beta*(controls - mean)
+
+
+class LowOrderProfiles:
+    """Failure profiles with up to order failed bridges besides a bridge of
+    interest e, and their probabilities (weighted by the failure probability
+    of e as the risk samples of delay_samples)
+
+    The probability that all bridges of a set T fail (with e) is
+
+        p_T = E[pf_e*P(Z_i <= ppf(pf_i|e) for i in T)]
+
+    with Z the correlated field of FailureSampler, exactly by enumeration of
+    the condition states of e and of the bridges of T (states with
+    probabilities below tol are neglected), by the normal cdf for one bridge,
+    bivariate_normal_cdf for two and scipy.stats.mvn for more (expensive, for
+    small networks only). The probability of profile S (the bridges of S fail,
+    all others are safe) is approximated by inclusion-exclusion truncated at
+    order,
+
+        q(S) = sum_{T >= S, |T| <= order} (-1)**(|T|-|S|)*p_T
+
+    so that the probabilities of all profiles sum to E[pf_e], and the mass of
+    the truncated profiles (more than order failed bridges besides e) is
+    bounded by sum_{|T| = k} p_T / C(order+1, k) for k <= order (at least
+    C(order+1, k) sets T of size k fail with more than order bridges) and,
+    if tight, by sum_{|T| = order+1} p_T (each p_T bounded by the smallest
+    p_T' of its subsets of size order if order > 1, the pairwise p_T
+    otherwise, as expensive as the enumeration itself). The approximation is
+    accurate if the failures of the other bridges are rare.
+
+    Parameters
+    ----------
+    sampler: FailureSampler
+    order: largest number of failed bridges besides e
+    tol: probability of the condition states below which they are neglected
+    tight: if True, the truncated mass is also bounded with the sets of
+        order+1 bridges
+    """
+    def __init__(self, sampler, order=1, tol=1e-12, tight=False):
+        self.sampler = sampler
+        self.order = order
+        self.tol = tol
+        self.tight = tight
+        self.state_pfs, self.state_pk = sampler.state_tables()
+
+    def thresholds(self, bridge_indx):
+        """Weights (pk*pf_e) of the condition states of bridge_indx and the
+        thresholds of the field of all bridges in each of these states
+        (nstate_e, nbridge, ncs**2)"""
+        pfe = self.state_pfs
+        states = np.flatnonzero((self.state_pk[bridge_indx] >= self.tol) & (pfe > 0.))
+        rho = self.sampler.correlation[bridge_indx]
+        pf1 = conditional_pf(pfe[states,None,None], self.state_pfs[None,None,:], rho[None,:,None])
+        return self.state_pk[bridge_indx, states]*pfe[states], stats.norm.ppf(np.clip(pf1, 0., 1.))
+
+    def joint_pfs(self, bridge_indx, size):
+        """p_T of all sets T of size bridges other than bridge_indx (dict keyed by tuples of bridge indices)"""
+        weights, h = self.thresholds(bridge_indx)
+        pk = np.where(self.state_pk >= self.tol, self.state_pk, 0.)
+        others = np.delete(np.arange(self.sampler.nbridge), bridge_indx)
+        if size > others.size:
+            return {}
+        if size == 0:
+            return {(): np.sum(weights)}
+        if size == 1:
+            p = np.dot(weights, np.sum(pk[others]*stats.norm.cdf(h[:,others,:]), axis=-1))
+            return dict(zip([(i,) for i in others], p))
+        correlation = self.sampler.correlation
+        if size == 2:
+            first, second = [np.array(x, dtype=int) for x in zip(*itertools.combinations(others, 2))]
+            rho = correlation[first, second][:,None]
+            p = np.zeros(first.size)
+            for weight, ha in zip(weights, h):
+                for state in np.flatnonzero(np.any(pk[first] > 0., axis=0)):
+                    joint = bivariate_normal_cdf(ha[first, state][:,None], ha[second], rho)
+                    p += weight*pk[first, state]*np.sum(pk[second]*joint, axis=1)
+            return dict(zip(zip(first, second), p))
+        p = {}
+        for bridges in itertools.combinations(others, size):
+            bridges = list(bridges)
+            covariance = correlation[np.ix_(bridges, bridges)]
+            # all condition states of the bridges of T at once: P(Z <= h) = P(Z-h <= 0)
+            states = np.array(list(itertools.product(*[np.flatnonzero(pk[i] > 0.) for i in bridges]))).T
+            state_weights = np.prod(pk[np.array(bridges)[:,None], states], axis=0)
+            p[tuple(bridges)] = 0.
+            for weight, ha in zip(weights, h):
+                upper = ha[np.array(bridges)[:,None], states]
+                kept = np.all(upper > -38., axis=0)
+                if not np.any(kept): continue
+                p[tuple(bridges)] += weight*mvn.mvnun_weighted(-np.inf*np.ones(size), np.zeros(size),
+                        -np.minimum(upper[:,kept], 38.), state_weights[kept], covariance)[0]
+        return p
+
+    def profiles(self, bridge_indx):
+        """Profiles of bridge_indx as a list of (bridges failed besides
+        bridge_indx, probability q), and the bound of the truncated mass"""
+        q = {}
+        p = []
+        for size in xrange(self.order+1):
+            p.append(self.joint_pfs(bridge_indx, size))
+            for bridges, pt in p[size].iteritems():
+                for nsub in xrange(size+1):
+                    for subset in itertools.combinations(bridges, nsub):
+                        q[subset] = q.get(subset, 0.) + (-1)**(size-nsub)*pt
+        # each truncated profile has at least C(order+1, size) failed sets of size bridges
+        tail = min([np.sum(p[size].values())/comb(self.order+1, size) for size in xrange(self.order+1)])
+        if self.tight and self.order < 2:
+            tail = min(tail, np.sum(self.joint_pfs(bridge_indx, self.order+1).values()))
+        elif self.tight:
+            # p_T <= p_T' for T' in T
+            bound = 0.
+            for bridges in itertools.combinations(np.delete(np.arange(self.sampler.nbridge), bridge_indx),
+                    self.order+1):
+                bound += min([p[self.order][subset] for subset in itertools.combinations(bridges, self.order)])
+            tail = min(tail, bound)
+        tail = max(tail, 0.)
+        return sorted(q.items(), key=lambda x: (len(x[0]), x[0])), tail
@@ -0,0 +1,98 @@
+import os
+import json
+import numpy as np
+
+# record of a sample: bridge index, block, sample id (of the bridge), seed of
+# the block, risk, total delay and total distance (little endian)
+RECORD = np.dtype([('bridge', '<i4'), ('block', '<i4'), ('sample', '<i4'), ('seed', '<i8'),
+    ('risk', '<f8'), ('delay', '<f8'), ('distance', '<f8')])
+
+
+class RunStore:
+    """Append-only store of the samples of a Monte Carlo run
+
+    The samples of each block are appended to path as one chunk of RECORD
+    records, written at once and flushed to disk, so that an interrupted run
+    loses the blocks in progress only. A partial record at the end of the file
+    (write interrupted by a crash) is dropped when the store is opened, and
+    samples of a block that was run again (after an incomplete chunk) are
+    taken from its last chunk. The parameters of the run are kept in
+    path+'.json' so that the run can be resumed with the same work units.
+
+    Parameters
+    ----------
+    path: file of the samples
+    resume: if True, an existing store is opened to resume its run, else
+        the store must not exist (so that a new run never returns the
+        samples of an old one)
+    """
+    def __init__(self, path, resume=False):
+        if not resume and (os.path.exists(path) or os.path.exists(path + '.json')):
+            raise IOError('run store {} exists, open it with resume=True to resume its run'.format(path))
+        if resume and not os.path.exists(path + '.json'):
+            raise IOError('no run to resume in {}'.format(path))
+        self.path = path
+        self.params = None
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory): os.makedirs(directory)
+        if os.path.exists(path + '.json'):
+            with open(path + '.json') as f:
+                self.params = json.load(f)
+        if os.path.exists(path):
+            size = os.path.getsize(path)
+            if size % RECORD.itemsize:
+                with open(path, 'r+b') as f:
+                    f.truncate(size - size % RECORD.itemsize)
+        self.file = open(path, 'ab')
+
+    def resume(self, params):
+        """Parameters of the run (dict): those of the store if any, which must
+        agree with params except for a seed of None, else params (with a seed
+        drawn if None), saved with the store"""
+        params = dict(params)
+        if self.params is not None:
+            stored = dict(self.params)
+            if params.get('seed') is None: params['seed'] = stored['seed']
+            if json.loads(json.dumps(params)) != stored:
+                raise ValueError('run store {} is of another run'.format(self.path))
+            return self.params
+        if params.get('seed') is None: params['seed'] = np.random.randint(2**31-1)
+        with open(self.path + '.json', 'w') as f:
+            json.dump(params, f)
+        self.params = json.loads(json.dumps(params))
+        return self.params
+
+    def append(self, bridge_indx, block, seed, first, risks, delays=None, distances=None):
+        """Append the samples of a block (sample ids from first on)"""
+        chunk = np.zeros(np.size(risks), dtype=RECORD)
+        chunk['bridge'], chunk['block'], chunk['seed'] = bridge_indx, block, seed
+        chunk['sample'] = first + np.arange(chunk.size)
+        chunk['risk'] = risks
+        chunk['delay'] = np.nan if delays is None else delays
+        chunk['distance'] = np.nan if distances is None else distances
+        self.file.write(chunk.tostring())
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def records(self):
+        """All records of the store, one per sample (the last one of each
+        bridge and sample id), ordered by bridge and sample id"""
+        self.file.flush()
+        records = np.fromfile(self.path, dtype=RECORD)
+        if records.size == 0: return records
+        # last record of each (bridge, sample)
+        order = np.lexsort((np.arange(records.size), records['sample'], records['bridge']))
+        records = records[order]
+        last = np.ones(records.size, dtype=bool)
+        last[:-1] = (records['bridge'][1:] != records['bridge'][:-1]) | (records['sample'][1:] != records['sample'][:-1])
+        return records[last]
+
+    def completed(self):
+        """Number of stored samples of each (bridge, block)"""
+        counts = {}
+        for bridge_indx, block in zip(*[self.records()[key].tolist() for key in ('bridge', 'block')]):
+            counts[(bridge_indx, block)] = counts.get((bridge_indx, block), 0) + 1
+        return counts
+
+    def close(self):
+        self.file.close()
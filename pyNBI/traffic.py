@@ -14,9 +14,13 @@ import copy
 
 import pyDUE.ue_solver as ue
 import pyDUE.draw_graph as d
+from pyDUE.sensitivity import linear_response, total_delay_gradient
+from pyDUE.cost_kernel import as_flow_array
 from pyDUE.util import distance_on_unit_sphere
 from pyNataf.robust import semidefinitive
 from pyNBI.risk import bridge_cost, social_cost
+from pyNBI.cache import ProfileCache, FlowCache, profile_key
+from pyNBI.sampling import cs2reliable, FailureSampler, ConditionForecast, LowOrderProfiles, profile_keys
 from cvxopt import matrix, mul
 
 def retrieve_bridge_db(cur_gis, cur_nbi):
@@ -66,36 +70,15 @@ def cs2reliable_linear(cs):
     beta = (4.7-0.0)/(8-2)*(cs-8)+4.7
     return beta
 
-def cs2reliable(cs):
-    rho = (4.84-1)/(8.-2.)*(cs-2) + 1.
-    beta = (rho-1.)/np.sqrt(rho**2*0.15**2+(2.5*0.15)**2)
-    return beta
-
-def condition_distribution(year, bridge_db, pmatrix):
-    cs_dist = []
-    cs = np.arange(8,0,-1)
-    pmatrix = pmatrix.item()
+def condition_distribution(year, bridge_db, pmatrix, forecast=None):
+    """ConditionDistribution of the bridges of bridge_db after year
+    -Input: forecast is a ConditionForecast of pmatrix caching its matrix powers
+    over several calls (created if None)"""
     if int(year) % 2 !=0:
         print 'illegal year of interest, must be even number'
-    else:
-        indx = int(year)/2
-    for (name, lat, long, length, width, deck_cs0, super_cs0, sub_cs0, detour, onlink) in bridge_db:
-        # create reliability index distribution of deck
-        deck_cs0_array = (cs==deck_cs0).astype('float')
-        deck_pk = np.dot(np.linalg.matrix_power(pmatrix['deck'].T,indx),deck_cs0_array)
-        deck_cs_dist = stats.rv_discrete(name='deck_cs_dist', values=(cs,deck_pk))
-        # create super
-        super_cs0_array = (cs==super_cs0).astype('float')
-        super_pk = np.dot(np.linalg.matrix_power(pmatrix['super'].T,indx),super_cs0_array)
-        super_cs_dist = stats.rv_discrete(name='super_cs_dist', values=(cs,super_pk))
-        # create sub
-        sub_cs0_array = (cs==sub_cs0).astype('float')
-        sub_pk = np.dot(np.linalg.matrix_power(pmatrix['sub'].T,indx),sub_cs0_array)
-        sub_cs_dist = stats.rv_discrete(name='sub_cs_dist', values=(cs,sub_pk))
-
-        cs_dist.append( (name, deck_cs_dist, super_cs_dist, sub_cs_dist) )
-
-    return cs_dist
+        return
+    if forecast is None: forecast = ConditionForecast(pmatrix)
+    return forecast.distribution(year, bridge_db)
 
 def generate_bridge_safety_deprecated(cs_dist):
     bridge_smps = []
@@ -222,76 +205,220 @@ def update_links(graph,fail_bridge_db,initial_link_cap,cap_drop_array,parameters
                 capacity,length,freespeed))
     graph.modify_links_from_lists(to_update_links, delaytype)
 
+def failure_sensitivities(graph, all_capacity, bridge_db, cap_drop_array, theta, linkflows, step=1e-3,
+        solver=None, rerouting=True):
+    """First-order changes of the total delay and total distance of the
+    network at UE (linkflows) for the failure of each bridge (update_links
+    with cap_drop_array), for all bridges from the gradients of the total
+    delay and distance with respect to the link delays (pyDUE.sensitivity,
+    four UE solutions with solver, ue.solver_gp if None, a RuntimeError being
+    raised if one of them does not reach its relative gap). If rerouting is
+    False, flows are fixed (no UE), which is less accurate for small changes
+    but often ranks large ones (long detours) better
+    -Output: changes of the total delay due to the capacity drop and due to
+    the detour (ffdelay change) of the on-links, and changes of the total
+    distance, each (nbridge,)"""
+    theta = np.asarray(theta, dtype=float).ravel()
+    powers = np.arange(1, theta.size+1)
+    x = as_flow_array(linkflows)
+    length_vector = np.zeros(graph.numlinks)
+    for link_key, link_indx in graph.indlinks.iteritems():
+        length_vector[link_indx] = graph.links[link_key].length
+    if rerouting:
+        delay_gradient = total_delay_gradient(graph, linkflows, step, solver=solver)
+        distance_gradient = linear_response(graph, linkflows, length_vector, step, solver=solver)
+    else:
+        delay_gradient, distance_gradient = x, np.zeros(graph.numlinks)
+    nbridge = bridge_db.shape[0]
+    ddelay_cap, ddelay_detour, ddistance = np.zeros(nbridge), np.zeros(nbridge), np.zeros(nbridge)
+    initial_link_cap = get_initial_capacity(graph, all_capacity, bridge_db)
+    for b, (bridge, ini_caps, cap_drop) in enumerate(zip(bridge_db, initial_link_cap, cap_drop_array)):
+        bridge_detour = bridge[-2]
+        for on_link, ini_cap in zip(bridge[-1], ini_caps):
+            link = graph.links[on_link]
+            link_indx = graph.indlinks[on_link]
+            # changes of ffdelay*(1+sum_k theta_k*(x/capacity)^k) at fixed flow as in update_links
+            ratio = np.power(x[link_indx]/link.capacity, powers)
+            dcap = min(ini_cap*(1.-cap_drop), link.capacity) - link.capacity
+            ddelay = -link.delayfunc.ffdelay*np.dot(theta*powers, ratio)/link.capacity*dcap
+            ddelay_cap[b] += delay_gradient[link_indx]*ddelay
+            ddistance[b] += distance_gradient[link_indx]*ddelay
+            ddelay = (1.+np.dot(theta, ratio))*bridge_detour*1e3/link.freespeed
+            ddelay_detour[b] += delay_gradient[link_indx]*ddelay
+            ddistance[b] += distance_gradient[link_indx]*ddelay + x[link_indx]*bridge_detour*1e3
+    return ddelay_cap, ddelay_detour, ddistance
+
+def screening_risks(graph, all_capacity, t, bridge_db, cs_dist, cap_drop_array, theta, linkflows, corrcoef=0.,
+        step=1e-3, solver=None, rerouting=True):
+    """Risk proxies of the bridges for screening: failure probability of each
+    bridge times its cost under first-order changes of the total delay and
+    distance of the network at UE (failure_sensitivities), other bridges intact"""
+    ddelay_cap, ddelay_detour, ddistance = failure_sensitivities(graph, all_capacity, bridge_db,
+            cap_drop_array, theta, linkflows, step, solver, rerouting)
+    pfs = FailureSampler(cs_dist, corrcoef=corrcoef).mean_pfs()
+    risks = np.zeros(bridge_db.shape[0])
+    for b in xrange(bridge_db.shape[0]):
+        # social_cost is linear in total delay and distance
+        cost = social_cost(ddelay_cap[b]+ddelay_detour[b], ddistance[b], t)
+        risks[b] = pfs[b]*(bridge_cost(bridge_db[b:b+1], t)+cost)
+    return risks
+
+def solve_failure_profile(graph, all_capacity, fail_bridges, cap_drop_after_fail, theta, delaytype, x0=None,
+        solver=None):
+    """Solve UE with the on-links of fail_bridges updated by update_links in a
+    scenario overlay of graph (graph itself is not modified and can be reused
+    for the next profile without copying it).
+    -Input: solver is a UE solver with the signature of ue.solver_fw (e.g.
+    ue.solver_bush for tight gaps), ue.solver_fw if None
+    -Output: total_delay, total_distance and link flows of the damaged network"""
+    if solver is None: solver = ue.solver_fw
+    scenario = graph.overlay()
+    initial_link_cap = get_initial_capacity(graph, all_capacity, fail_bridges)
+    update_links(scenario,fail_bridges,initial_link_cap,cap_drop_after_fail,theta,delaytype)
+    res = solver(scenario, full=True, x0=x0)
+    total_delay = res[1][0,0]
+    length_vector = np.zeros(scenario.numlinks)
+    for link_key, link_indx in scenario.indlinks.iteritems():
+        length_vector[link_indx] = scenario.links[link_key].length
+    total_distance = (res[0].T * matrix(length_vector))[0,0]
+    return total_delay, total_distance, res[0]
+
+def resolve_failure_profile(graph, all_capacity, fail_bridges, cap_drop_after_fail, theta, delaytype,
+        key, solutions, x0=None, solver=None):
+    """Incremental version of solve_failure_profile: UE is warm-started from the
+    link flows of the cached profile nearest to key (in number of bridges with a
+    different state), or from x0 if solutions is empty, and the link flows of
+    the damaged network are added to solutions (a pyNBI.cache.FlowCache).
+    Results agree with solve_failure_profile within the tolerance of solver_fw.
+    -Output: total_delay, total_distance and link flows of the damaged network"""
+    nearest, flows = solutions.nearest(key)
+    if flows is not None: x0 = flows
+    total_delay, total_distance, linkflows = solve_failure_profile(graph, all_capacity, fail_bridges,
+            cap_drop_after_fail, theta, delaytype, x0=x0, solver=solver)
+    solutions[key] = np.array(linkflows).ravel()
+    return total_delay, total_distance, linkflows
+
+def failure_profile(bridge_safety_smp, bridge_indx=None):
+    """Boolean array of failed bridges from the samples of generate_bridge_safety
+    (bridge_indx is set to failed if given) and its bitset key"""
+    fail = np.array([not smp for name, smp in bridge_safety_smp], dtype=bool)
+    if bridge_indx is not None:
+        fail[bridge_indx] = True
+    return fail, profile_key(fail)
+
 def delay_samples(nsmp, graph0, cost0, all_capacity, t, bridge_indx, bridge_db, cs_dist,
-        cap_drop_array, theta, delaytype, correlation=None, nataf=None, corrcoef=0., x0=None, bookkeeping={}):
+        cap_drop_array, theta, delaytype, correlation=None, nataf=None, corrcoef=0., x0=None, bookkeeping=None,
+        solutions=None, solver=None, sampler=None, proposal=None, method='mc', control=None, full=False):
+    # bookkeeping: dict-like cache of [total_delay, total_distance] keyed by
+    # the bitset of failed bridges (e.g. pyNBI.cache.ProfileCache or SharedProfileCache)
+    # solutions: FlowCache of link flows to warm-start UE of new profiles,
+    # seeded with x0 (the flows of the undamaged network)
+    # solver: UE solver of solve_failure_profile (ue.solver_fw if None)
+    # sampler: FailureSampler of cs_dist, correlation and corrcoef (created if None)
+    # proposal: if not None, importance sampling density of the field (e.g.
+    # design_point_proposal), risk samples are then weighted by their likelihood
+    # ratios (so that their mean is the risk, see weighted_estimate)
+    # method: 'mc', 'antithetic' or 'lhs' sampling of the profiles (FailureSampler.draw)
+    # control: DetourControlVariate, risk samples are then corrected by the control
+    # full: if True, total delays and total distances of the samples are also returned
+    if proposal is not None and method != 'mc':
+        raise ValueError('importance sampling (proposal) only supports method mc, not {}'.format(method))
+    if bookkeeping is None: bookkeeping = ProfileCache()
+    if solutions is None: solutions = FlowCache()
+    if sampler is None: sampler = FailureSampler(cs_dist, correlation, corrcoef)
+    if x0 is not None and len(solutions) == 0: solutions[0] = np.array(x0).ravel()
+    # sample all failure profiles at once
+    if proposal is None:
+        randoms, weights = sampler.draw(nsmp, method=method), np.ones(int(nsmp))
+    else:
+        randoms, weights = sampler.importance_draw(nsmp, proposal)
+    fails, pfs = sampler.profiles(*randoms, bridge_indx=bridge_indx)
+    keys = profile_keys(fails)
     # start MC
     bridge_risk_array=[]
+    total_delay_array, total_distance_array = np.zeros(len(keys)), np.zeros(len(keys))
     # eccostlog = []
     # socostlog = []
-    #total_delay_array = []
-    for i in xrange(int(nsmp)):
-        bridge_safety_smp, bridge_pfs = generate_bridge_safety(cs_dist, bridge_indx,
-                correlation, nataf, corrcoef)
-        # update link input
-        bridge_safety_profile = np.asarray(bridge_safety_smp,dtype=object)[:,1].astype('int')
-        bridge_safety_profile[bridge_indx] = 0
-        #if tuple(bridge_safety_profile) in bookkeeping.iterkeys():
-        #multiprocessing.managers.DictProxy has no iterkeys attribute, see http://bugs.python.org/issue9733
-        if tuple(bridge_safety_profile) in iter(bookkeeping.keys()):
-            total_delay = bookkeeping[tuple(bridge_safety_profile)][0]
-            total_distance = bookkeeping[tuple(bridge_safety_profile)][1]
-            cost = social_cost(total_delay, total_distance, t)
-            fail_bridges = bridge_db[np.logical_not(bridge_safety_profile.astype(bool))]
-            bridgecost = bridge_cost(fail_bridges, t)
-            bridge_risk = bridge_pfs[bridge_indx][-1]*(bridgecost+(cost-cost0))
+    for i, (fail, key, bridge_pfs, weight) in enumerate(zip(fails, keys, pfs, weights)):
+        fail_bridges = bridge_db[fail]
+        cached = bookkeeping.get(key)
+        if cached is not None:
+            total_delay, total_distance = cached[0], cached[1]
         else:
-            graph = copy.deepcopy(graph0)
-            fail_bridges = bridge_db[np.logical_not(bridge_safety_profile.astype(bool))]
-            initial_link_cap = get_initial_capacity(graph, all_capacity, fail_bridges)
-            cap_drop_after_fail = cap_drop_array[np.logical_not(bridge_safety_profile.astype(bool))]
-            update_links(graph,fail_bridges,initial_link_cap,cap_drop_after_fail,theta,delaytype)
-            res = ue.solver_fw(graph, full=True, x0=x0)
+            total_delay, total_distance, linkflows = resolve_failure_profile(graph0, all_capacity,
+                    fail_bridges, cap_drop_array[fail], theta, delaytype, key, solutions, x0=x0,
+                    solver=solver)
             # save to bookkeeping
-            total_delay = res[1][0,0]
-            length_vector = np.zeros(len(graph.links.keys()))
-            for link_key, link_indx in graph.indlinks.iteritems():
-                length_vector[link_indx] = graph.links[link_key].length
-            total_distance = (res[0].T * matrix(length_vector))[0,0]
-            bookkeeping[tuple(bridge_safety_profile)] = [total_delay, total_distance]
-            cost = social_cost(total_delay, total_distance, t)
-            bridgecost = bridge_cost(fail_bridges, t)
-            bridge_risk = bridge_pfs[bridge_indx][-1]*(bridgecost+(cost-cost0))
+            bookkeeping[key] = [total_delay, total_distance]
+        total_delay_array[i], total_distance_array[i] = total_delay, total_distance
+        cost = social_cost(total_delay, total_distance, t)
+        bridgecost = bridge_cost(fail_bridges, t)
+        bridge_risk = weight*bridge_pfs[bridge_indx]*(bridgecost+(cost-cost0))
         # add to total delay samples and risk samples
-        #total_delay_array.append(total_delay)
         bridge_risk_array.append(bridge_risk)
         # eccostlog.append(bridgecost)
         # socostlog.append(cost-cost0)
-    #total_delay_array = np.asarray(total_delay_array)
     bridge_risk_array = np.asarray(bridge_risk_array)
+    if control is not None:
+        controls = weights*control.values(fails, pfs, bridge_indx)
+        bridge_risk_array = control.adjust(bridge_risk_array, controls, control.mean(bridge_indx))
 
+    if full: return bridge_indx, bridge_risk_array, total_delay_array, total_distance_array
     return bridge_indx, bridge_risk_array
 
-def delay_history(nsmp, graph, t, bridge_db, cs_dist, cap_drop_array, theta, delaytype, bookkeeping={}):
+def enumerated_risk(graph0, cost0, all_capacity, t, bridge_indices, bridge_db, cs_dist, cap_drop_array,
+        theta, delaytype, correlation=None, corrcoef=0., order=1, x0=None, bookkeeping=None, solutions=None,
+        solver=None, tol=1e-12, tight=False):
+    # risks of bridge_indices without sampling: all failure profiles with up
+    # to order failed bridges besides the bridge of interest are enumerated
+    # with their probabilities (pyNBI.sampling.LowOrderProfiles), and UE of
+    # each distinct profile is solved once for all bridges (bookkeeping)
+    # -Output: risks of bridge_indices and bounds of the probability mass of
+    # the truncated profiles (more than order failed bridges besides the
+    # bridge of interest), tighter but as expensive as the enumeration if tight
+    if bookkeeping is None: bookkeeping = ProfileCache()
+    if solutions is None: solutions = FlowCache()
+    if x0 is not None and len(solutions) == 0: solutions[0] = np.array(x0).ravel()
+    enumeration = LowOrderProfiles(FailureSampler(cs_dist, correlation, corrcoef), order, tol, tight)
+    risks, tails = np.zeros(len(bridge_indices)), np.zeros(len(bridge_indices))
+    for n, bridge_indx in enumerate(bridge_indices):
+        profiles, tails[n] = enumeration.profiles(bridge_indx)
+        for bridges, prob in profiles:
+            fail = np.zeros(bridge_db.shape[0], dtype=bool)
+            fail[bridge_indx] = True
+            fail[list(bridges)] = True
+            key = profile_key(fail)
+            fail_bridges = bridge_db[fail]
+            cached = bookkeeping.get(key)
+            if cached is not None:
+                total_delay, total_distance = cached[0], cached[1]
+            else:
+                total_delay, total_distance, linkflows = resolve_failure_profile(graph0, all_capacity,
+                        fail_bridges, cap_drop_array[fail], theta, delaytype, key, solutions, x0=x0,
+                        solver=solver)
+                bookkeeping[key] = [total_delay, total_distance]
+            cost = social_cost(total_delay, total_distance, t)
+            risks[n] += prob*(bridge_cost(fail_bridges, t)+(cost-cost0))
+    return risks, tails
 
+def delay_history(nsmp, graph, t, bridge_db, cs_dist, cap_drop_array, theta, delaytype, bookkeeping=None,
+        solver=None):
+    # total delays of nsmp failure profiles, each solved in a scenario overlay
+    # of the undamaged graph (solve_failure_profile, with solver)
+    if bookkeeping is None: bookkeeping = ProfileCache()
     # start MC
     total_delay_array = []
-    all_capacity = np.zeros(nlink)
+    all_capacity = np.zeros(len(graph.links))
     for link, link_indx in graph.indlinks.iteritems():
-        all_capacity[link_indx] = graph.links[link].cap
-    for i in xrange(nsmp):
-        bridge_safety_smp = generate_bridge_safety(cs_dist)
-        # update link input
-        bridge_safety_profile = np.asarray(bridge_safety_smp)[:,1].astype('int')
-        if tuple(bridge_safety_profile) in iter(bookkeeping.keys()):
-            total_delay = bookkeeping[tuple(bridge_safety_profile)]
-        else:
-            fail_bridges = bridge_db[np.logical_not(bridge_safety_profile.astype(bool))]
-            initial_link_cap = get_initial_capacity(graph, all_capacity, fail_bridges)
-            cap_drop_after_fail = cap_drop_array[np.logical_not(bridge_safety_profile.astype(bool))]
-            update_links(graph,fail_bridges,initial_link_cap,cap_drop_after_fail,theta,delaytype)
-            total_delay = assign_traffic(graph, algorithm='FW', output=False)
+        all_capacity[link_indx] = graph.links[link].capacity
+    fails, pfs = FailureSampler(cs_dist).sample(nsmp)
+    for fail, key in zip(fails, profile_keys(fails)):
+        total_delay = bookkeeping.get(key)
+        if total_delay is None:
+            total_delay = solve_failure_profile(graph, all_capacity, bridge_db[fail], cap_drop_array[fail],
+                    theta, delaytype, solver=solver)[0]
             # save to bookkeeping
-            bookkeeping[tuple(bridge_safety_profile)] = total_delay
+            bookkeeping[key] = total_delay
         # add to total delay samples
         total_delay_array.append(total_delay)
     total_delay_array = np.asarray(total_delay_array)
@@ -299,34 +426,25 @@ def delay_history(nsmp, graph, t, bridge_db, cs_dist, cap_drop_array, theta, del
     return t, total_delay_array
 
 def flow_samples(nsmp, graph0, cost0, all_capacity, t, bridge_indx, bridge_db, cs_dist,
-        cap_drop_array, theta, delaytype, correlation=None, nataf=None, corrcoef=0., x0=None, bookkeeping={}):
+        cap_drop_array, theta, delaytype, correlation=None, nataf=None, corrcoef=0., x0=None, bookkeeping=None):
+    if bookkeeping is None: bookkeeping = ProfileCache()
     # start MC
     graphs = []
     graphres = []
     bridgeCond = []
     bridge_risk_array=[]
     #total_delay_array = []
-    for i in xrange(int(nsmp)):
-        bridge_safety_smp, bridge_pfs = generate_bridge_safety(cs_dist, bridge_indx,
-                correlation, nataf, corrcoef)
-        # update link input
-        bridge_safety_profile = np.asarray(bridge_safety_smp,dtype=object)[:,1].astype('int')
-        bridge_safety_profile[bridge_indx] = 0
-        bridgeCond.append(bridge_safety_profile)
-        #if tuple(bridge_safety_profile) in bookkeeping.iterkeys():
-        #multiprocessing.managers.DictProxy has no iterkeys attribute, see http://bugs.python.org/issue9733
-        if tuple(bridge_safety_profile) in iter(bookkeeping.keys()):
-            total_delay = bookkeeping[tuple(bridge_safety_profile)][0]
-            total_distance = bookkeeping[tuple(bridge_safety_profile)][1]
-            cost = social_cost(total_delay, total_distance, t)
-            fail_bridges = bridge_db[np.logical_not(bridge_safety_profile.astype(bool))]
-            bridgecost = bridge_cost(fail_bridges, t)
-            bridge_risk = bridge_pfs[bridge_indx][-1]*(bridgecost+(cost-cost0))
+    fails, pfs = FailureSampler(cs_dist, correlation, corrcoef).sample(nsmp, bridge_indx)
+    for fail, key, bridge_pfs in zip(fails, profile_keys(fails), pfs):
+        bridgeCond.append(np.logical_not(fail).astype('int'))
+        fail_bridges = bridge_db[fail]
+        cached = bookkeeping.get(key)
+        if cached is not None:
+            total_delay, total_distance = cached[0], cached[1]
         else:
-            graph = copy.deepcopy(graph0)
-            fail_bridges = bridge_db[np.logical_not(bridge_safety_profile.astype(bool))]
+            graph = graph0.overlay()
             initial_link_cap = get_initial_capacity(graph, all_capacity, fail_bridges)
-            cap_drop_after_fail = cap_drop_array[np.logical_not(bridge_safety_profile.astype(bool))]
+            cap_drop_after_fail = cap_drop_array[fail]
             update_links(graph,fail_bridges,initial_link_cap,cap_drop_after_fail,theta,delaytype)
             res = ue.solver_fw(graph, full=True, x0=x0)
             graphs.append(graph)
@@ -338,10 +456,10 @@ def flow_samples(nsmp, graph0, cost0, all_capacity, t, bridge_indx, bridge_db, c
             for link_key, link_indx in graph.indlinks.iteritems():
                 length_vector[link_indx] = graph.links[link_key].length
             total_distance = (res[0].T * matrix(length_vector))[0,0]
-            bookkeeping[tuple(bridge_safety_profile)] = [total_delay, total_distance]
-            cost = social_cost(total_delay, total_distance, t)
-            bridgecost = bridge_cost(fail_bridges, t)
-            bridge_risk = bridge_pfs[bridge_indx][-1]*(bridgecost+(cost-cost0))
+            bookkeeping[key] = [total_delay, total_distance]
+        cost = social_cost(total_delay, total_distance, t)
+        bridgecost = bridge_cost(fail_bridges, t)
+        bridge_risk = bridge_pfs[bridge_indx]*(bridgecost+(cost-cost0))
         # add to total delay samples and risk samples
         #total_delay_array.append(total_delay)
         bridge_risk_array.append(bridge_risk)
@@ -0,0 +1,45 @@
+import numpy as np
+import pyDUE.ue_solver as ue
+import pyDUE.Graph as g
+
+
+def parallel_links(seed=20, numnodes=10, numlinks=30, numparallel=6, numODs=20):
+    """Random strongly connected network (a ring plus random links) with
+    parallel links and congested BPR delays"""
+    rng = np.random.RandomState(seed)
+    graph = g.Graph('Parallel links')
+    for i in range(numnodes): graph.add_node((i, 0))
+    pairs = set([(i+1, i%numnodes+2, 1) for i in range(numnodes-1)] + [(numnodes, 1, 1)])
+    while len(pairs) < numlinks:
+        u, v = rng.randint(1, numnodes+1, 2)
+        if u != v: pairs.add((u, v, 1))
+    single = sorted(pairs)
+    for k in rng.choice(len(single), numparallel, replace=False):
+        pairs.add((single[k][0], single[k][1], 2))
+    links = []
+    for startnode, endnode, route in sorted(pairs):
+        ff_d, cap = 10.*rng.randint(1, 10), 100.*rng.randint(2, 10)
+        slope = 1./cap
+        coef = [ff_d*a*b for a,b in zip([0.0, 0.0, 0.0, 0.15], np.power(slope, range(1,5)))]
+        links.append((startnode, endnode, route, ff_d, (ff_d, slope, coef), cap, None, None))
+    graph.add_links_from_list(links, 'Polynomial')
+    ods = set()
+    while len(ods) < numODs:
+        o, d = rng.randint(1, numnodes+1, 2)
+        if o != d and (o, d) not in ods:
+            ods.add((o, d))
+            graph.add_od(o, d, 100.*rng.randint(1, 10))
+    return graph
+
+
+def test_bush_convergence():
+    """algorithm B reaches a relative gap of 1e-10 and the UE of solver_gp"""
+    gaps = []
+    x = ue.solver_bush(parallel_links(), e=1e-10, niter=1000, trace=gaps)
+    assert gaps[-1] < 1e-10
+    x_gp = ue.solver_gp(parallel_links(), e=1e-12, niter=3000)[1]
+    assert np.allclose(np.array(x).ravel(), np.array(x_gp).ravel(), atol=1e-3)
+
+
+if __name__ == '__main__':
+    test_bush_convergence()